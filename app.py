@@ -1,6 +1,7 @@
 import dash_bootstrap_components as dbc
 from dash import Dash, html, dcc
 from collections import defaultdict
+import uuid
 
 from callbacks.update_res import *  
 from components.header import layout as header
@@ -10,6 +11,7 @@ from components.waitlist import layout as unlabelled_tomos
 from components.annotators import layout as ranking
 from components.composition import layout as composition
 from components.popups import layout as popups
+from utils.thumbnail_route import register_thumbnail_route
 
 
 external_stylesheets = [dbc.themes.BOOTSTRAP, 
@@ -18,8 +20,10 @@ external_stylesheets = [dbc.themes.BOOTSTRAP,
                         "https://use.fontawesome.com/releases/v5.10.2/css/all.css"] 
 
 app = Dash(__name__, external_stylesheets=external_stylesheets)
+register_thumbnail_route(app)
 
-browser_cache =html.Div(
+def browser_cache():
+    return html.Div(
         id="no-display",
         children=[
             dcc.Interval(
@@ -27,38 +31,54 @@ browser_cache =html.Div(
                 interval=20*1000, # clientside check in milliseconds, 10s
                 n_intervals=0
                 ),
+            dcc.Store(id='stats-versions', data=None),   # etags of the statistics shown, see LocalDataset.versions
+            dcc.Store(id='session-id', data=uuid.uuid4().hex),   # key of the review state of this page in copick_dataset.sessions
             dcc.Store(id='tomogram-index', data=''),
             dcc.Store(id='keybind-num', data=''),
-            dcc.Store(id='run-dt', data=defaultdict(list))
+            dcc.Store(id='gallery-version', data=0),   # bumped when the points of the gallery classes change
+            dcc.Store(id='run-dt', data=defaultdict(list)),   # {'run': run name} once the run of the popup is loaded
+            dcc.Store(id='run-load', data=None),   # background job loading the run of the popup
+            dcc.Interval(
+                id='run-load-interval',
+                interval=500, # progress polling in milliseconds while a run is loading
+                n_intervals=0,
+                disabled=True
+                ),
         ],
     )
 
 
-app.layout = html.Div(
-    [
-        header(),
-        popups(),
-        dbc.Container(
-            [
-                dbc.Row(
-                    [
-                        dbc.Col([tomo_progress(),
-                                 unlabelled_tomos()
-                                 ], 
-                                 width=3), 
-                        dbc.Col(ranking(), width=3),
-                        dbc.Col(composition(), width=3),
-                        dbc.Col(protein_sts(), width=3),
-                    ],
-                    justify='center',
-                    className="h-100",
-                ),
-            ],
-            fluid=True,
-        ),
-        html.Div(browser_cache)
-    ],
-)
+
+def serve_layout():
+    # a function, so that every page load gets its own review session
+    return html.Div(
+        [
+            header(),
+            popups(),
+            dbc.Container(
+                [
+                    dbc.Row(
+                        [
+                            dbc.Col([tomo_progress(),
+                                     unlabelled_tomos()
+                                     ], 
+                                     width=3), 
+                            dbc.Col(ranking(), width=3),
+                            dbc.Col(composition(), width=3),
+                            dbc.Col(protein_sts(), width=3),
+                        ],
+                        justify='center',
+                        className="h-100",
+                    ),
+                ],
+                fluid=True,
+            ),
+            html.Div(browser_cache())
+        ],
+    )
+
+
+app.layout = serve_layout
 
 
 
@@ -0,0 +1,67 @@
+'''
+Compares payload size and encode time of the thumbnail encoders on a synthetic gallery page.
+
+    python benchmarks/thumbnail_encoding.py [--n 50] [--hw 60] [--repeat 5]
+'''
+import os, io, sys, time, argparse
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.thumbnail_encoder import ThumbnailEncoder
+
+
+def synthetic_page(n, hw, seed=0):
+    # smooth background with gaussian noise, roughly like averaged tomogram slabs
+    rng = np.random.default_rng(seed)
+    size = 2*hw + 1
+    yy, xx = np.mgrid[:size, :size]
+    blobs = np.exp(-((yy-hw)**2 + (xx-hw)**2) / (2*(hw/4)**2))
+    return (blobs[None] * rng.uniform(0.5, 2, (n, 1, 1)) + rng.normal(0, 0.5, (n, size, size))).astype(np.float32)
+
+
+def legacy_encode(images):
+    # figure_utils.arr2base64, per image float64 normalization and PNG at PIL's default level
+    # (the gallery then embedded it base64 encoded, 4/3 of these bytes)
+    thumbnails = []
+    for image in images:
+        normalized = (image - np.min(image)) / (np.max(image) - np.min(image))
+        buffer = io.BytesIO()
+        Image.fromarray((normalized * 255).astype('uint8')).save(buffer, format='PNG')
+        thumbnails.append(buffer.getvalue())
+    return thumbnails
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n', type=int, default=50, help='thumbnails per page')
+    parser.add_argument('--hw', type=int, default=60, help='half width of the crops')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    images = synthetic_page(args.n, args.hw)
+    encoders = [('png, level 6 (PIL default)', ThumbnailEncoder('png', compress_level=6, workers=1)),
+                ('png, level 1', ThumbnailEncoder('png', compress_level=1, workers=1)),
+                ('png, level 1, 4 threads', ThumbnailEncoder('png', compress_level=1, workers=4)),
+                ('jpeg q85', ThumbnailEncoder('jpeg', quality=85, workers=1)),
+                ('jpeg q85, 4 threads', ThumbnailEncoder('jpeg', quality=85, workers=4)),
+                ('webp q80', ThumbnailEncoder('webp', quality=80, workers=1)),
+                ('webp q80, 4 threads', ThumbnailEncoder('webp', quality=80, workers=4)),
+               ]
+    print(f'{args.n} thumbnails of {2*args.hw+1}x{2*args.hw+1} px')
+    print(f'{"encoder":32s} {"ms/page":>10s} {"KiB/page":>10s}')
+    for name, encode in [('arr2base64 (legacy)', legacy_encode)] + [(name, e.encode_batch) for name, e in encoders]:
+        try:
+            encode(images)   # warm up
+        except (OSError, KeyError, ValueError) as e:
+            print(f'{name:32s} unavailable ({e})')
+            continue
+        t0 = time.perf_counter()
+        for _ in range(args.repeat):
+            thumbnails = encode(images)
+        elapsed = (time.perf_counter() - t0) / args.repeat
+        print(f'{name:32s} {elapsed*1000:10.1f} {sum(len(t) for t in thumbnails)/1024:10.1f}')
+
+
+if __name__ == '__main__':
+    main()
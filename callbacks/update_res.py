@@ -1,23 +1,27 @@
 import plotly.express as px
 import dash_bootstrap_components as dbc
-import json, time
+import json
 import pandas as pd
-from collections import defaultdict
-from apscheduler.schedulers.background import BackgroundScheduler
 
-import time
-from utils.copick_dataset import copick_dataset
+from utils.copick_dataset import sessions
 from utils.figure_utils import (
     blank_fig,
-    draw_gallery
+    crop_bounds,
+    draw_gallery,
+    scatter3d_lod,
+    MAX_SCATTER_POINTS,
+    SCATTER_FOCUS_RADIUS,
 )
 from utils.local_dataset import (
     dataset, 
-    dirs, 
-    dir2id, 
-    COUNTER_FILE_PATH, 
     CACHE_ROOT,
+    LIVE_UPDATES_MODE,
+    POLL_INTERVAL,
+    RESCAN_INTERVAL,
 )
+from utils.pick_watcher import start_live_updates
+from utils.thumbnail_prefetch import thumbnail_prefetcher
+from utils.run_loader import run_loader
 from dash import (
     html,
     Input,
@@ -86,10 +90,8 @@ def parse_contents(contents, filename, date):
 # 1st update of the internal states
 dataset.refresh()
 
-#Scheduler
-scheduler = BackgroundScheduler() # in-memory job stores
-scheduler.add_job(func=dataset.refresh, trigger='interval', seconds=20)  # interval should be larger than the time it takes to refresh, o.w. it will be report incomplete stats.
-scheduler.start()
+# Live updates, from filesystem events where supported, polling otherwise
+live_updates = start_live_updates(dataset, mode=LIVE_UPDATES_MODE, interval=POLL_INTERVAL, rescan_interval=RESCAN_INTERVAL)
 
 
 roundbutton = {
@@ -110,7 +112,7 @@ roundbutton = {
 
 
 def candidate_list(i, j):
-    return  dbc.ListGroupItem("{} (labeled by {} person)".format(dirs[i], j))
+    return  dbc.ListGroupItem("{} (labeled by {} person)".format(dataset.runs.name(i), j))
 
 def ranking_list(i, j):
     return  dbc.ListGroupItem("{} {} tomograms".format(i, j))
@@ -196,22 +198,53 @@ def reset_analysis_popup(tomogram_index):
 
 
 @callback(
+    Output("run-load", "data"),
+    Output("run-load-interval", "disabled"),
     Output("run-dt", "data"),
     Input("tomogram-index", "data"),
+    State("session-id", "data"),
     prevent_initial_call=True
 )
-def load_tomogram_run(tomogram_index):
-    dt = defaultdict(list)
-    if tomogram_index is not None:
-        # takes 18s for VPN
-        t1 = time.time()
-        copick_dataset.load_curr_run(run_name=tomogram_index, sort_by_score=True)
-        # takes 0.2s
-        t2 = time.time()
-        print('find copick run in copick', t2-t1)
-        
+def load_tomogram_run(tomogram_index, session_id):
+    # loading takes up to 18s for VPN, it runs in the background and is polled by poll_run_load
+    if tomogram_index is None:
+        raise PreventUpdate
+    copick_dataset = sessions.get(session_id)
+    thumbnail_prefetcher.cancel(copick_dataset)
+    job_id = run_loader.submit(copick_dataset, tomogram_index, sort_by_score=True)
+    return {'job_id': job_id, 'run': tomogram_index}, False, dict()
+
+
+@callback(
+    Output("run-load-progress", "value"),
+    Output("run-load-progress", "label"),
+    Output("run-load-progress", "color"),
+    Output("run-load-progress", "style"),
+    Output("run-load-interval", "disabled", allow_duplicate=True),
+    Output("run-dt", "data", allow_duplicate=True),
+    Input("run-load-interval", "n_intervals"),
+    State("run-load", "data"),
+    prevent_initial_call=True
+)
+def poll_run_load(n, run_load):
+    '''
+    Reports the progress of the run being loaded and signals readiness through run-dt,
+    which the views of the evaluation popup wait for.
+    '''
+    job = run_loader.status(run_load['job_id']) if run_load else None
+    if job is None:
+        return 0, '', 'primary', {'display': 'none'}, True, no_update
+    if job['state'] == 'ready':
+        return 100, 'Ready', 'success', {'display': 'none'}, True, {'run': job['run']}
+    if job['state'] in ('failed', 'cancelled'):
+        return 100, job['message'], 'danger', {'display': 'flex'}, True, no_update
+    return job['progress'], job['message'], 'primary', {'display': 'flex'}, False, no_update
 
-    return dt
+
+def run_ready(copick_dataset, tomogram_index, run_dt):
+    # the run of the popup finished loading into the session's dataset
+    return bool(tomogram_index) and bool(run_dt) and run_dt.get('run') == tomogram_index and \
+           copick_dataset.run_name == tomogram_index
 
 
 @callback(
@@ -225,143 +258,212 @@ def reset_slider(value, nrow, ncol):
     return 0
 
 
+def page_positions(copick_dataset, slider_value, nrow, ncol, particle):
+    # positions of the points of a particle shown on a gallery page
+    page_size = nrow*ncol
+    return [i for i in range(slider_value*page_size, min((slider_value+1)*page_size, len(copick_dataset.points_per_obj[particle])))]
+
+
+def pressed_key_of(keybind_event_listener):
+    return keybind_event_listener.get("key", None) if keybind_event_listener else None
+
+
 @callback(
-    Output("output-image-upload", "children"),
-    Output("particle-dropdown", "options"),
     Output("fig1", "figure"),
+    Output("particle-dropdown", "options"),
+    Input("tabs", "active_tab"),
+    Input("run-dt", "data"),
+    Input("fig1", "clickData"),
+    State("tomogram-index", "data"),
+    State("session-id", "data"),
+    prevent_initial_call=True
+)
+def update_3d_view(at, run_dt, click_data, tomogram_index, session_id):
+    copick_dataset = sessions.get(session_id)
+    if not run_ready(copick_dataset, tomogram_index, run_dt):
+        return blank_fig(), dict()
+    if at == "tab-1":
+        particle_dict = {k: k for k in sorted(set(copick_dataset.dt['pickable_object_name']))}
+        # a click shows the picks around the clicked marker at full resolution
+        focus = None
+        if ctx.triggered_id == "fig1" and click_data and click_data.get('points'):
+            point = click_data['points'][0]
+            focus = (point['x'], point['y'], point['z'])
+        fig1 = scatter3d_lod(copick_dataset.dt, max_points=MAX_SCATTER_POINTS, focus=focus, focus_radius=SCATTER_FOCUS_RADIUS)
+        return fig1, particle_dict
+    particle_dict = {k: k for k in sorted(set(copick_dataset.dt['pickable_object_name']))}
+    return blank_fig(), particle_dict
+
+
+@callback(
+    Output("crop-label", "children"),
+    Input("tabs", "active_tab"),
+    Input("run-dt", "data"),
+    State("tomogram-index", "data"),
+    State("session-id", "data"),
+    prevent_initial_call=True
+)
+def update_crop_label(at, run_dt, tomogram_index, session_id):
+    copick_dataset = sessions.get(session_id)
+    if at != "tab-2" or not run_ready(copick_dataset, tomogram_index, run_dt):
+        raise PreventUpdate
+    max_hw, _ = crop_bounds(copick_dataset.tomogram)
+    return f"Image crop width (max {2*max_hw+1})"
+
+
+@callback(
     Output("image-slider", "max"),
     Output("image-slider", "marks"),
-    Output("crop-label", "children"),
-    Output("image-slider", "value", allow_duplicate=True),
-    Output("keybind-num", "data"),
+    Input("particle-dropdown", "value"),
+    Input("display-row", "value"),
+    Input("display-col", "value"),
+    Input("gallery-version", "data"),
+    State("session-id", "data"),
+    prevent_initial_call=True
+)
+def update_slider_bounds(particle, nrow, ncol, gallery_version, session_id):
+    copick_dataset = sessions.get(session_id)
+    slider_max = 0
+    if particle in copick_dataset.points_per_obj and nrow and ncol:
+        slider_max = max(-(-len(copick_dataset.points_per_obj[particle]) // (nrow*ncol)) - 1, 0)
+    return slider_max, {0: '0', slider_max: str(slider_max)}
+
+
+@callback(
+    Output("output-image-upload", "children"),
     Input("tabs", "active_tab"),
     Input("image-slider", "value"),
     Input("crop-width", "value"),
     Input("crop-avg", "value"),
     Input("particle-dropdown", "value"),
+    Input("display-row", "value"),
+    Input("display-col", "value"),
+    Input("gallery-version", "data"),
+    Input("run-dt", "data"),
+    State("tomogram-index", "data"),
+    State("session-id", "data"),
+    prevent_initial_call=True
+)
+def update_gallery(at, slider_value, crop_width, crop_avg, particle, nrow, ncol, gallery_version, run_dt, tomogram_index, session_id):
+    '''
+    Renders the thumbnails of the current page, the only callback that (re-)renders images.
+    '''
+    copick_dataset = sessions.get(session_id)
+    if at != "tab-2" or not run_ready(copick_dataset, tomogram_index, run_dt) or crop_width is None or not nrow or not ncol:
+        raise PreventUpdate
+    # the thumbnail route only serves crops within these bounds
+    max_hw, max_avg = crop_bounds(copick_dataset.tomogram)
+    half_width = min(max(crop_width//2, 0), max_hw)
+    crop_avg = min(max(crop_avg or 0, 0), max_avg)
+    positions = page_positions(copick_dataset, slider_value, nrow, ncol, particle)
+    fig2 = draw_gallery(copick_dataset, run=tomogram_index, particle=particle, positions=positions, hw=half_width, avg=crop_avg, nrow=nrow, ncol=ncol)
+    # the next page is likely to be requested next
+    thumbnail_prefetcher.prefetch(copick_dataset, particle, slider_value, nrow*ncol, half_width, crop_avg)
+    return fig2
+
+
+@callback(
+    Output("image-slider", "value", allow_duplicate=True),
+    Input("keybind-event-listener", "n_events"),
+    State("keybind-event-listener", "event"),
+    State("tabs", "active_tab"),
+    State("image-slider", "value"),
+    State("image-slider", "max"),
+    prevent_initial_call=True
+)
+def navigate_pages(n_events, keybind_event_listener, at, slider_value, slider_max):
+    pressed_key = pressed_key_of(keybind_event_listener)
+    if at != "tab-2":
+        raise PreventUpdate
+    if pressed_key == 'ArrowRight' and slider_value < (slider_max or 0):
+        return slider_value + 1
+    elif pressed_key == 'ArrowLeft' and slider_value:
+        return slider_value - 1
+    raise PreventUpdate
+
+
+@callback(
+    Output({'type': 'thumbnail-image', 'index': ALL}, 'n_clicks', allow_duplicate=True),
+    Output("gallery-version", "data"),
+    Output("keybind-num", "data"),
     Input("accept-bttn", "n_clicks"),
     Input("reject-bttn", "n_clicks"),
     Input("assign-bttn", "n_clicks"),
-    Input("username-analysis", "value"),
-    Input("keybind-event-listener", "event"),
     Input("keybind-event-listener", "n_events"),
-    Input("display-row", "value"),
-    Input("display-col", "value"),
-    State("tomogram-index", "data"),
-    State("fig1", "figure"),
-    State("output-image-upload", "children"),
-    State("keybind-num", "data"),
+    State("keybind-event-listener", "event"),
+    State("tabs", "active_tab"),
+    State("image-slider", "value"),
+    State("particle-dropdown", "value"),
+    State("display-row", "value"),
+    State("display-col", "value"),
+    State("username-analysis", "value"),
     State({'type': 'thumbnail-image', 'index': ALL}, 'n_clicks'),
     State("assign-dropdown", "value"),
+    State("keybind-num", "data"),
+    State("gallery-version", "data"),
+    State("run-dt", "data"),
+    State("tomogram-index", "data"),
+    State("session-id", "data"),
     prevent_initial_call=True
 )
-def update_analysis(
-    at, 
-    slider_value, 
-    crop_width, 
-    crop_avg, 
-    particle, 
-    accept_bttn, 
-    reject_bttn, 
-    assign_bttn, 
-    copicklive_username,
-    keybind_event_listener, 
+def handle_decision(
+    accept_bttn,
+    reject_bttn,
+    assign_bttn,
     n_events,
+    keybind_event_listener,
+    at,
+    slider_value,
+    particle,
     nrow,
     ncol,
-    tomogram_index, 
-    fig1, 
-    fig2, 
-    kbn, 
+    copicklive_username,
     thumbnail_image_select_value,
-    new_particle
+    new_particle,
+    kbn,
+    gallery_version,
+    run_dt,
+    tomogram_index,
+    session_id
 ):
+    '''
+    Applies accept (A), reject (D) and assign (S) to the selected thumbnails. Accept and reject
+    only reset the selection, which recolors the cards (select_thumbnail) without re-rendering
+    the images. Assign moves points to another class, so the gallery is rendered again.
+    '''
     pressed_key = None
     if ctx.triggered_id == "keybind-event-listener":
         #user is going to type in the class creation/edit modals and we don't want to trigger this callback using keys
-        pressed_key = (
-            keybind_event_listener.get("key", None) if keybind_event_listener else None
-        )
+        pressed_key = pressed_key_of(keybind_event_listener)
         if not pressed_key:
             raise PreventUpdate
         else:
             print(f'pressed_key {pressed_key}')
-    
-    slider_max = 0
-    changed_id = [p['prop_id'] for p in ctx.triggered][0]
-    # takes 0.35s on mac3
-    if tomogram_index:
-        #time.sleep(7)
-        #particle_dict = {k: k for k in sorted(set(copick_dataset.dt['pickable_object_name']))}
-        if at == "tab-1":
-            time.sleep(2)
-            particle_dict = {k: k for k in sorted(set(copick_dataset.dt['pickable_object_name']))}
-            df = pd.DataFrame.from_dict(copick_dataset.dt)
-            fig1 = px.scatter_3d(df, x='x', y='y', z='z', color='pickable_object_name', symbol='user_id', size='size', opacity=0.5)
-            return fig2, particle_dict, fig1, slider_max, {0: '0', slider_max: str(slider_max)}, no_update, no_update, no_update
-        elif at == "tab-2":
-            #new_particle = None
-            if pressed_key in [str(i+1) for i in range(len(dataset._im_dataset['name']))]:
-                new_particle = dataset._im_dataset['name'][int(pressed_key)-1]
-            elif pressed_key == 's':
-                new_particle = kbn
-
-            copick_dataset.new_user_id(user_id=copicklive_username)
-            if ("display-row" in changed_id or\
-                "display-col" in changed_id) or \
-                particle in copick_dataset.points_per_obj:
-                if len(copick_dataset.points_per_obj[particle])%(nrow*ncol):
-                    slider_max = len(copick_dataset.points_per_obj[particle])//(nrow*ncol)
-                else:
-                    slider_max = len(copick_dataset.points_per_obj[particle])//(nrow*ncol) - 1
-                        
-            positions = [i for i in range(slider_value*nrow*ncol, min((slider_value+1)*nrow*ncol, len(copick_dataset.points_per_obj[particle])))] 
-            # loading zarr takes 6-8s for VPN
-            particle_dict = {k: k for k in sorted(set(copick_dataset.dt['pickable_object_name']))}
-            dim_z, dim_y, dim_x = copick_dataset.tomogram.shape
-            msg = f"Image crop width (max {min(dim_x, dim_y)})"
-            if crop_width is not None:
-                half_width = crop_width//2
-                if crop_avg is None:
-                    crop_avg = 0
-                fig2 = draw_gallery(run=tomogram_index, particle=particle, positions=positions, hw=half_width, avg=crop_avg, nrow=nrow, ncol=ncol)
-
-
-            selected = [i for i,v in enumerate(thumbnail_image_select_value) if v%2 == 1]
-            selected_point_ids = [positions[i] for i in selected]
-            if 'accept-bttn' in changed_id or pressed_key=='a':
-                copick_dataset.handle_accept_batch(selected_point_ids, particle)
-            elif 'reject-bttn' in changed_id or pressed_key=='d':
-                copick_dataset.handle_reject_batch(selected_point_ids, particle)
-            elif 'assign-bttn' in changed_id or pressed_key=='s':
-                copick_dataset.handle_assign_batch(selected_point_ids, particle, new_particle)
-
-            # update figures
-            # if 'accept-bttn' in changed_id or \
-            #    'reject-bttn' in changed_id or \
-            #    'assign-bttn' in changed_id or \
-            #    pressed_key in ['a', 'd', 's']:
-            #     slider_value += 1
-            #     positions = [i for i in range(slider_value*nrow*ncol, min((slider_value+1)*nrow*ncol, len(copick_dataset.points_per_obj[particle])))] 
-            #     fig2 = draw_gallery(run=tomogram_index, particle=particle, positions=positions, hw=half_width, avg=crop_avg, nrow=nrow, ncol=ncol)
-            
-            if 'assign-bttn' in changed_id or pressed_key == 's':
-                positions = [i for i in range(slider_value*nrow*ncol, min((slider_value+1)*nrow*ncol, len(copick_dataset.points_per_obj[particle])))] 
-                fig2 = draw_gallery(run=tomogram_index, particle=particle, positions=positions, hw=half_width, avg=crop_avg, nrow=nrow, ncol=ncol)    
-            
-            if pressed_key=='ArrowRight' and slider_value < slider_max:
-                slider_value += 1
-                positions = [i for i in range(slider_value*nrow*ncol, min((slider_value+1)*nrow*ncol, len(copick_dataset.points_per_obj[particle])))] 
-                fig2 = draw_gallery(run=tomogram_index, particle=particle, positions=positions, hw=half_width, avg=crop_avg, nrow=nrow, ncol=ncol)
-            elif pressed_key=='ArrowLeft' and slider_value:
-                slider_value -= 1
-                positions = [i for i in range(slider_value*nrow*ncol, min((slider_value+1)*nrow*ncol, len(copick_dataset.points_per_obj[particle])))] 
-                fig2 = draw_gallery(run=tomogram_index, particle=particle, positions=positions, hw=half_width, avg=crop_avg, nrow=nrow, ncol=ncol)
-
-            return fig2, particle_dict, blank_fig(), slider_max, {0: '0', slider_max: str(slider_max)}, msg, slider_value, new_particle
-    else:
-        return fig2, dict(), blank_fig(), slider_max, {0: '0', slider_max: str(slider_max)}, no_update, no_update, no_update
-
+    copick_dataset = sessions.get(session_id)
+    if at != "tab-2" or not run_ready(copick_dataset, tomogram_index, run_dt) or particle not in copick_dataset.points_per_obj:
+        raise PreventUpdate
+
+    unchanged = [no_update for _ in thumbnail_image_select_value]
+    if pressed_key in [str(i+1) for i in range(len(dataset._im_dataset['name']))]:
+        return unchanged, no_update, dataset._im_dataset['name'][int(pressed_key)-1]
+    elif pressed_key == 's':
+        new_particle = kbn
+
+    copick_dataset.new_user_id(user_id=copicklive_username)
+    positions = page_positions(copick_dataset, slider_value, nrow, ncol, particle)
+    selected = [i for i,v in enumerate(thumbnail_image_select_value) if v and v%2 == 1 and i < len(positions)]
+    selected_point_ids = [positions[i] for i in selected]
+    deselected = [0 for _ in thumbnail_image_select_value]
+    if ctx.triggered_id == 'accept-bttn' or pressed_key=='a':
+        copick_dataset.handle_accept_batch(selected_point_ids, particle)
+        return deselected, no_update, no_update
+    elif ctx.triggered_id == 'reject-bttn' or pressed_key=='d':
+        copick_dataset.handle_reject_batch(selected_point_ids, particle)
+        return deselected, no_update, no_update
+    elif ctx.triggered_id == 'assign-bttn' or pressed_key=='s':
+        copick_dataset.handle_assign_batch(selected_point_ids, particle, new_particle)
+        return unchanged, (gallery_version or 0) + 1, no_update
+    raise PreventUpdate
 
 
 
@@ -375,6 +477,7 @@ def update_analysis(
     State("display-col", "value"),
     State("particle-dropdown", "value"), 
     State({'type': 'thumbnail-image', 'index': MATCH}, 'id'), 
+    State("session-id", "data"),
 )
 def select_thumbnail(value, 
                      select_clicks, 
@@ -382,7 +485,8 @@ def select_thumbnail(value,
                      slider_value, 
                      nrow, ncol, 
                      particle, 
-                     comp_id):
+                     comp_id,
+                     session_id):
     '''
     This callback assigns a color to thumbnail cards in the following scenarios:
         - An image has been selected, but no label has been assigned (blue)
@@ -393,11 +497,12 @@ def select_thumbnail(value,
     Returns:
         thumbnail_color:            Color of thumbnail card
     '''
+    copick_dataset = sessions.get(session_id)
     color = ''
     colors = ['', 'success', 'danger', 'warning']
     positions = [i for i in range(slider_value*nrow*ncol, min((slider_value+1)*nrow*ncol, len(copick_dataset.points_per_obj[particle])))]
     #print(f'positions {positions}')
-    selected = [copick_dataset.picked_points_mask[copick_dataset.points_per_obj[particle][i][0]] for i in positions]
+    selected = [copick_dataset.picked_points_mask[copick_dataset.points_per_obj[particle][i]] for i in positions]
     #print(f'selected {selected}')
     #print(f'comp_id {comp_id}')
     color = colors[selected[int(comp_id['index'])]]
@@ -460,24 +565,15 @@ def download_json(n_clicks, input_value):
 @callback(
     Output("download-txt", "data"),
     Input("btn-download-txt", "n_clicks"),
-    #State("username", "value"),
+    State("username", "value"),
+    State("session-id", "data"),
     prevent_initial_call=True,
 )
-def download_txt(n_clicks):
-    with open(COUNTER_FILE_PATH) as f:
-        counter = json.load(f)
-    
-    if counter['repeat'] == 2:
-        counter['start'] += counter['tasks_per_person']
-        counter['repeat'] = 0
-
-    counter['repeat'] += 1
-    task_contents = '\n'.join(dirs[counter['start']:counter['start']+counter['tasks_per_person']])
+def download_txt(n_clicks, input_value, session_id):
+    # runs are leased per user, anonymous users per browser session
+    user_id = '.'.join(input_value.split()) if input_value and input_value.strip() else f'session-{session_id}'
+    task_contents = '\n'.join(dataset.lease_tasks(user_id))
     task_filename = 'task_recommendation.txt' 
-
-    with open(COUNTER_FILE_PATH, 'w') as f:
-        f.write(json.dumps(counter, indent=4))   
-    
     return dict(content=task_contents, filename=task_filename)
 
 
@@ -488,30 +584,46 @@ def download_txt(n_clicks):
     Output('total-labeled', 'children'),
     Output('progress-bar', 'value'),
     Output('progress-bar', 'label'),
-    Input('interval-component', 'n_intervals')
+    Output('stats-versions', 'data'),
+    Input('interval-component', 'n_intervals'),
+    State('stats-versions', 'data'),
 )
-def update_results(n):
-    data = dataset.fig_data()
-    fig = px.bar(x=data['name'], 
-                 y=data['count'], 
-                 labels={'x': 'Objects', 'y':'Counts'}, 
-                 text_auto=True,
-                 color = data['name'],
-                 color_discrete_map = data['colors'],
-                 )
-    fig.update(layout_showlegend=False)
-    num_candidates = len(dirs) if len(dirs) < 100 else 100
-    candidates = dataset.candidates(num_candidates, random_sampling=False)
-    num_per_person_ordered = dataset.num_per_person_ordered 
-    label = f'Labeled {len(dataset.tomos_pickers)} out of 1000 tomograms'
-    bar_val = round(len(dataset.tomos_pickers)/1000*100, 1)
+def update_results(n, shown_versions):
+    '''
+    Renders the parts of the results whose etag differs from the one the page already shows,
+    see LocalDataset.versions.
+    '''
+    stats = dataset.snapshot()
+    versions = dataset.versions(stats)
+    shown_versions = shown_versions or {}
+    changed = {k for k, v in versions.items() if shown_versions.get(k) != v}
+    if not changed:
+        raise PreventUpdate
+
+    fig = waitlist = rank = label = bar_val = bar_label = no_update
+    if 'stats' in changed:
+        data = dataset.fig_data(stats)
+        fig = px.bar(x=data['name'], 
+                     y=data['count'], 
+                     labels={'x': 'Objects', 'y':'Counts'}, 
+                     text_auto=True,
+                     color = data['name'],
+                     color_discrete_map = data['colors'],
+                     )
+        fig.update(layout_showlegend=False)
+        num_per_person_ordered = stats.num_per_person_ordered 
+        rank = dbc.ListGroup([ranking_list(i, len(j)) for i, j in num_per_person_ordered.items()], numbered=True)
+    if 'waitlist' in changed:
+        num_candidates = len(dataset.runs) if len(dataset.runs) < 100 else 100
+        candidates = dataset.candidates(num_candidates)
+        waitlist = dbc.ListGroup([candidate_list(i, j) for i, j in candidates.items()], flush=True)
+    if 'stats' in changed or 'runs' in changed:
+        num_tomograms = max(len(dataset.runs), 1)
+        label = [f'Labeled {len(stats.tomos_pickers)} out of {len(dataset.runs)} tomograms']
+        bar_val = round(len(stats.tomos_pickers)/num_tomograms*100, 1)
+        bar_label = f'{bar_val}%'
     
-    return fig, \
-           dbc.ListGroup([candidate_list(i, j) for i, j in candidates.items()], flush=True), \
-           dbc.ListGroup([ranking_list(i, len(j)) for i, j in num_per_person_ordered.items()], numbered=True), \
-           [label], \
-           bar_val, \
-           f'{bar_val}%'
+    return fig, waitlist, rank, label, bar_val, bar_label, versions
 
 
 @callback(
@@ -522,10 +634,11 @@ def update_results(n):
 def update_compositions(n):
     progress_list = []
     composition_list = html.Div()
-    data = dataset.fig_data()
+    stats = dataset.snapshot()
+    data = dataset.fig_data(stats)
     l = 1/len(data['colors'])*100
     obj_order = {name:i for i,name in enumerate(data['name'])}
-    tomograms = {k:v for k,v in sorted(dataset.tomograms.items(), key=lambda x: dir2id[x[0]])} 
+    tomograms = {k:v for k,v in sorted(stats.tomograms.items(), key=lambda x: dataset.runs.id(x[0]))} 
     for tomogram,ps in tomograms.items():
         progress = []
         ps = [p for p in ps if p in obj_order]
@@ -90,6 +90,7 @@ tabs = html.Div(
         ),
         html.Div([
             dbc.Label("Choose results", id='choose-results', style={'margin-top': '35px', 'margin-left': '7px'}),
+            dbc.Progress(id='run-load-progress', value=0, label='', striped=True, animated=True, style={'display': 'none'}),
             dcc.Dropdown(["Pickathon results"], 'Pickathon results', id='pick-dropdown', style={'width':'42%', 'justify-content': 'center', 'margin-bottom': '0px', 'margin-left': '4px'}),
             dbc.Collapse(id="collapse1",is_open=False, children=dbc.Spinner(dcc.Graph(id='fig1', figure=blank_fig()), spinner_style={"width": "5rem", "height": "5rem"})),
             dbc.Collapse(id="collapse2",is_open=False, children=dbc.Container([dbc.Row(
@@ -1,102 +1,309 @@
-import os
+import os, time, json
 import configparser
+import threading
 from copick.impl.filesystem import CopickRootFSSpec
 from collections import defaultdict
-import pandas as pd
+import numpy as np
 import zarr
 
+from utils.pick_cache import PickCache, PointTable
+from utils.operation_log import operation_log
+from utils.decision_store import DecisionStore
+from utils.thumbnail_prefetch import thumbnail_prefetcher
+from utils.figure_utils import grid_voxels
+
 
 config = configparser.ConfigParser()
 config.read(os.path.join(os.getcwd(), "config.ini"))
 COPICKLIVE_CONFIG_PATH = '%s' % config['copicklive_config']['COPICKLIVE_CONFIG_PATH']
 COPICK_TEMPLATE_PATH = '%s' % config['copick_template']['COPICK_TEMPLATE_PATH']
+CACHE_ROOT = '%s' % config['local_cache']['CACHE_ROOT']
+TOMOGRAM_CACHE_MB = config.getint('local_cache', 'TOMOGRAM_CACHE_MB', fallback=256)   # chunk cache per opened tomogram
+DEDUP_TOLERANCE = config.getfloat('review', 'DEDUP_TOLERANCE', fallback=0.0)   # in Angstrom, 0 merges identical locations only
+SESSION_IDLE_TIMEOUT = config.getint('review', 'SESSION_IDLE_TIMEOUT', fallback=3600)   # seconds before an idle review session is closed
+
+
+def empty_index():
+    return np.empty(0, dtype=np.int64)
+
+
+def first_unique_rows(locations):
+    # indices of the first occurrence of each distinct row, in order. A stable lexsort and a
+    # comparison of neighbours is several times faster than np.unique(axis=0)
+    if not len(locations):
+        return empty_index()
+    order = np.lexsort(locations.T[::-1])
+    ordered = locations[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = np.any(ordered[1:] != ordered[:-1], axis=1)
+    return np.sort(order[first])
+
+
+def tomogram_key(run_name, store, array):
+    # changes when the array is rewritten, falls back to the run name and array metadata
+    signature = None
+    fs = getattr(store, 'fs', None)
+    root = getattr(store, 'path', None)   # FSStore
+    if fs is not None and root is not None:
+        try:
+            info = fs.info(f"{root}/{array.path}/.zarray" if array.path else f"{root}/.zarray")
+            signature = info.get('mtime', info.get('LastModified', info.get('ETag')))
+        except (OSError, ValueError):
+            pass
+    return (run_name, array.path, array.shape, str(array.dtype), str(signature))
+
+def store_picks(pick_set):
+    '''
+    Stores a pick set. On local filesystems the file is replaced atomically (written to a
+    temporary file, fsync'ed and renamed), so a crash never leaves a truncated pick file.
+    Other filesystems fall back to copick's store().
+    '''
+    fs = getattr(pick_set, 'fs', None)
+    meta = getattr(pick_set, 'meta', None)
+    protocol = getattr(fs, 'protocol', None)
+    protocols = protocol if isinstance(protocol, (tuple, list)) else [protocol]
+    if meta is None or not ('file' in protocols or 'local' in protocols):
+        pick_set.store()
+        return
+    path = fs._strip_protocol(pick_set.path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    contents = meta.model_dump() if hasattr(meta, 'model_dump') else meta.dict()
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(contents, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+
+class TomogramCache:
+    '''
+    Opened tomograms shared by all sessions, reference counted by run name, so reviewers of the
+    same run share one array and its chunk cache. A tomogram is closed with its last reference.
+    '''
+    def __init__(self, max_size: int=TOMOGRAM_CACHE_MB * 2**20):
+        self.max_size = max_size
+        self._entries = dict()   # {run_name: {'array': zarr array, 'key': tomogram key, 'refs': 1}}
+        self._lock = threading.Lock()
+        self._opening = dict()   # {run_name: [lock, acquirers]}, one opener per run, dropped when no acquire is pending
+
+
+    def acquire(self, run_name, run):
+        # (array, key) of the denoised tomogram of a run, opened on first use
+        with self._lock:
+            opening = self._opening.setdefault(run_name, [threading.Lock(), 0])
+            opening[1] += 1
+        try:
+            with opening[0]:
+                with self._lock:
+                    entry = self._entries.get(run_name)
+                    if entry is not None:
+                        entry['refs'] += 1
+                        return entry['array'], entry['key']
+                tomogram = run.get_voxel_spacing(10).get_tomogram("denoised")
+                # Access the data lazily, only the chunks under the crops are fetched and the most recent are kept
+                tomogram_store = tomogram.zarr()
+                store = zarr.LRUStoreCache(tomogram_store, max_size=self.max_size)
+                group = zarr.open(store, mode='r')
+                _, array = list(group.arrays())[0]  # highest resolution bin=0
+                key = tomogram_key(run_name, tomogram_store, array)
+                with self._lock:
+                    self._entries[run_name] = {'array': array, 'key': key, 'refs': 1}
+                return array, key
+        finally:
+            with self._lock:
+                opening[1] -= 1
+                if opening[1] == 0:
+                    del self._opening[run_name]
+
+
+    def release(self, run_name):
+        with self._lock:
+            entry = self._entries.get(run_name)
+            if entry is not None:
+                entry['refs'] -= 1
+                if entry['refs'] <= 0:
+                    del self._entries[run_name]
+
+
+    def get(self, run_name):
+        # (array, key) of an opened tomogram without taking a reference, None if not opened
+        with self._lock:
+            entry = self._entries.get(run_name)
+            return (entry['array'], entry['key']) if entry is not None else None
 
 
 
 class CopickDataset:
-    def __init__(self, copick_config_path: str=None, copick_config_path_tomogram: str=None):
-        self.root = CopickRootFSSpec.from_file(copick_config_path) if copick_config_path else None
-        self.tomo_root = CopickRootFSSpec.from_file(copick_config_path_tomogram) if copick_config_path_tomogram else None
-        self.tomogram = None
+    '''
+    Review state of one session: the opened run, its points and the decisions of the reviewer.
+    The copick roots and the opened tomograms are shared between sessions.
+    '''
+    def __init__(self, copick_config_path: str=None, copick_config_path_tomogram: str=None, root=None, tomo_root=None, tomograms=None, session_id=None):
+        self.root = root if root is not None else CopickRootFSSpec.from_file(copick_config_path) if copick_config_path else None
+        self.tomo_root = tomo_root if tomo_root is not None else CopickRootFSSpec.from_file(copick_config_path_tomogram) if copick_config_path_tomogram else None
+        self._tomograms = tomograms if tomograms is not None else TomogramCache()
+        self.user_id = self.root.config.user_id if self.root is not None else None
+        self.session_id = session_id  # browser session holding the dataset, see SessionRegistry
+        self.closed = False
+        self.tomogram = None  # zarr array, chunks are read on demand
+        self.tomogram_key = None  # identifies the contents of the tomogram, e.g. for caching thumbnails
         self.run_name = None
         self.current_point = None  # current point index
-        self.current_point_obj = None  # current point copick object
         self.dt = defaultdict(list)
+        self._pick_cache = PickCache(CACHE_ROOT)  # columnar picks per run, memory mapped
         
         # variables for storing points in the current run
-        self.all_points = []  #[point_obj,...] unique pick objs from all pickers
-        self._point_types = []  #['ribosome',...]
-        self.points_per_obj = defaultdict(list) # {'ribosome': [(0,0.12),(2,0.33),(3,0.27...],...} (index, score)
-        self.all_points_locations = set() # {(x,y,z),...} a mask to check if a point is duplicated
-        # variables for storing picked points in the current run
-        self.picked_points_mask = [] #[1, 0, 2, 3, ...] # 1: accept, 2: reject, 0: unassigned, 3: assigned new class 
-        self._picked_id_per_obj = defaultdict(list) # {'ribosome': [0,3...],...}
-        self._picked_points_per_obj = defaultdict(list) # {'ribosome': [point_obj...],...}
-
-        self._logs = defaultdict(list) # {'user_id':[], 'x': [], 'y':[], 'z':[], 'operation':['reject', 'accept', 'reassign'], 'start_class':[], 'end_class'[]}
+        self.all_points = []  #[point_obj,...] unique pick objs from all pickers, materialized on access
+        # class, gallery order and review decision of each point in the current run
+        self._decisions = DecisionStore()
+        self._point_voxels = (None, set())  # (all_points, {(x, y, z), ...}) voxels of the points, see has_point_voxel
 
     
+    @property
+    def current_point_obj(self):
+        # copick object of the current point, materialized on access
+        return self.all_points[self.current_point] if self.current_point is not None else None
+
+
+    @property
+    def points_per_obj(self):
+        # {'ribosome': array([0,3,2,...]),...} point indices per object in gallery order, sorted by score if requested
+        return self._decisions
+
+
+    @property
+    def picked_points_mask(self):
+        # [1, 0, 2, ...] per point, 1: accept, 2: reject, 0: unassigned
+        return self._decisions.status
+
+
+    def has_point_voxel(self, voxel):
+        # whether a point of the current run lies on the voxel (x, y, z), e.g. to validate thumbnail requests
+        all_points, voxels = self._point_voxels
+        if all_points is not self.all_points:
+            all_points = self.all_points
+            voxels = set(map(tuple, grid_voxels(all_points.locations()).tolist())) if len(all_points) else set()
+            self._point_voxels = (all_points, voxels)
+        return tuple(voxel) in voxels
+
+
     def _reset_states(self):
-        self.points_per_obj = defaultdict(list)
-        self._point_types = []
         self.all_points = []
-        self.picked_points_mask = []
-        self._picked_id_per_obj = defaultdict(list)
-        self._picked_points_per_obj = defaultdict(list)
-        self.all_points_locations = set()
-        self._logs = defaultdict(list)
+        self._decisions = DecisionStore()
         self.dt = defaultdict(list)
         
 
     
-    def load_curr_run(self, run_name=None, sort_by_score=False, reverse=False):
-        if run_name is not None:
-            self._reset_states()
-            self.run_name = run_name
-            self.run = self.root.get_run(self.run_name)
-            _run = self.tomo_root.get_run(self.run_name) if self.tomo_root is not None else self.run
-            for pick in self.run.picks:
-                for point in pick.points:
-                    # all picks from indivial pickers to show in tab1, contain duplicated picks.
-                    self.dt['pickable_object_name'].append(pick.pickable_object_name)
-                    self.dt['user_id'].append(pick.user_id)
-                    self.dt['x'].append(float(point.location.x)/10)
-                    self.dt['y'].append(float(point.location.y)/10)
-                    self.dt['z'].append(float(point.location.z)/10)
-                    self.dt['size'].append(0.1)
-                    if (point.location.x, point.location.y, point.location.z) not in self.all_points_locations:
-                        self.points_per_obj[pick.pickable_object_name].append((len(self.all_points), point.score))
-                        self._point_types.append(pick.pickable_object_name)
-                        self.all_points.append(point)
-                        self.all_points_locations.add((point.location.x, point.location.y, point.location.z))
-            
-            self.picked_points_mask = [0]*len(self.all_points)
-            if sort_by_score:
-                for k,values in self.points_per_obj.items():
-                    if len(values):
-                        values.sort(key=lambda x: x[1], reverse=reverse) # reverse=Fasle, ascending order
-
-            tomogram = _run.get_voxel_spacing(10).get_tomogram("denoised")
-            # Access the data
-            group = zarr.open(tomogram.zarr())
-            _, array = list(group.arrays())[0]  # highest resolution bin=0
-            self.tomogram = array[:] 
+    def load_curr_run(self, run_name=None, sort_by_score=False, reverse=False, tolerance=DEDUP_TOLERANCE, progress=None):
+        '''
+        Loads the picks and opens the tomogram of a run. The new state is built aside and
+        swapped in at the end, so readers never see a partially loaded run.
+        Args:
+            progress:   optional callable progress(fraction, message) reporting the loading stages
+        '''
+        if run_name is None:
+            return
+        report = progress if progress is not None else lambda fraction, message: None
+        report(0.05, 'Opening run')
+        run = self.root.get_run(run_name)
+        _run = self.tomo_root.get_run(run_name) if self.tomo_root is not None else run
+        report(0.1, 'Reading picks')
+        columns, meta = self._pick_cache.load(run_name, run.picks)
+        objects = np.asarray(meta['objects'], dtype=object)
+        
+        # all picks from indivial pickers to show in tab1, contain duplicated picks.
+        dt = {'pickable_object_name': objects[columns['object_id']],
+              'user_id': np.asarray(meta['users'], dtype=object)[columns['user_id']],
+              'x': columns['x']/10,
+              'y': columns['y']/10,
+              'z': columns['z']/10,
+              'size': np.full(meta['n'], 0.1),
+             }
+        
+        report(0.6, 'Merging picks')
+        # unique points from all pickers, the first pick of a location wins.
+        # With a tolerance, locations are merged on a grid of that spacing.
+        locations = np.stack([columns['x'], columns['y'], columns['z']], axis=1)
+        if tolerance > 0:
+            locations = np.round(locations/tolerance).astype(np.int64)
+        unique_rows = first_unique_rows(locations)
+        all_points = PointTable(columns, unique_rows)
+        point_objects = columns['object_id'][unique_rows]
+        
+        # point indices per object, by ascending score (reverse=False) if requested
+        points_per_obj = defaultdict(empty_index)
+        order = np.arange(len(unique_rows))
+        if sort_by_score:
+            scores = columns['score'][unique_rows]
+            order = np.argsort(-scores if reverse else scores, kind='stable')
+        order = order[np.argsort(point_objects[order], kind='stable')]
+        counts = np.bincount(point_objects, minlength=len(objects))
+        for obj_name, indices in zip(objects, np.split(order, np.cumsum(counts)[:-1])):
+            if len(indices):
+                points_per_obj[obj_name] = indices
+
+        report(0.8, 'Opening tomogram')
+        array, key = self._tomograms.acquire(run_name, _run)
+        if self.closed:
+            # the session was evicted while loading
+            self._tomograms.release(run_name)
+            return
+
+        self._release_tomogram()
+        self._reset_states()
+        self.run_name = run_name
+        self.run = run
+        self.dt = dt
+        self.all_points = all_points
+        self._decisions = DecisionStore(objects, point_objects, points_per_obj)
+        self.tomogram = array
+        self.tomogram_key = key
+        report(1.0, 'Ready')
+
+
+    def _release_tomogram(self):
+        if self.tomogram is not None:
+            self._tomograms.release(self.run_name)
+            self.tomogram = None
+            self.tomogram_key = None
+
+
+    def close(self):
+        # releases the shared resources of the session
+        self.closed = True
+        self._release_tomogram()
+        self._reset_states()
 
 
     def _store_points(self, obj_name=None, session_id='18'):
         if obj_name is not None:
-            _picks = self.run.get_picks(object_name=obj_name, user_id=self.root.user_id, session_id=session_id)
+            _picks = self.run.get_picks(object_name=obj_name, user_id=self.user_id, session_id=session_id)
             if not _picks:
-                _picks = self.run.new_picks(object_name=obj_name, user_id=self.root.user_id, session_id=session_id)
-                _picks = self.run.get_picks(object_name=obj_name, user_id=self.root.user_id, session_id=session_id)
+                _picks = self.run.new_picks(object_name=obj_name, user_id=self.user_id, session_id=session_id)
+                _picks = self.run.get_picks(object_name=obj_name, user_id=self.user_id, session_id=session_id)
             _pick_set = _picks[0]
-            _pick_set.points = self._picked_points_per_obj[obj_name]
-            _pick_set.store()
+            # copick points only exist while they are written
+            _pick_set.points = self.all_points.points(self._decisions.accepted(obj_name))
+            store_picks(_pick_set)
+            _pick_set.points = None
+
+
+    def _store_objects(self, obj_names):
+        # persists the picks of each object touched by a batch once
+        for obj_name in sorted(set(obj_names) - set([None])):
+            self._store_points(obj_name)
     
     
     def new_user_id(self, user_id=None):
+        # per session, the copick root is shared
         if user_id is not None:
-            self.root.config.user_id = user_id
+            self.user_id = user_id
     
 
     def load_curr_point(self, point_id=None, obj_name=None):
@@ -104,122 +311,152 @@ class CopickDataset:
             self.pickable_obj_name = obj_name 
             print("Creating current pick point")
             if len(self.points_per_obj[obj_name]): 
-                self.current_point = self.points_per_obj[obj_name][point_id][0]   # current point index
-                self.current_point_obj = self.all_points[self.current_point]
+                self._set_current_point(self.points_per_obj[obj_name][point_id])
             else:
                 self.current_point = None
-                self.current_point_obj = None
+
+
+    def _set_current_point(self, point):
+        self.current_point = int(point)   # current point index
     
     
     def change_obj_name(self, obj_name=None, enable_log=True):
-        if enable_log:
-            self.log_operation(operation='reasign', old_obj_name=self._point_types[self.current_point], new_obj_name=obj_name)
+        if enable_log and self.current_point is not None:
+            self.log_operation(operation='reasign', old_obj_name=self._decisions.class_name(self.current_point), new_obj_name=obj_name)
 
         if obj_name is not None and self.current_point is not None:
-            self._point_types[self.current_point] = obj_name
+            # the point moves to the front of the new object's gallery
+            self._decisions.reassign(self.current_point, obj_name)
         
     
-    def _update_logs(self, operation='placeholder', old_obj_name='NC', new_obj_name='NC'):
-        self._logs['run_name'].append(self.run_name)
-        self._logs['user_id'].append(self.root.config.user_id)
-        self._logs['x'].append(self.current_point_obj.location.x)
-        self._logs['y'].append(self.current_point_obj.location.y)
-        self._logs['z'].append(self.current_point_obj.location.z)
-        self._logs['operation'].append(operation)
-        self._logs['start_class'].append(old_obj_name)
-        self._logs['end_class'].append(new_obj_name)
-    
-    
     def log_operation(self, operation=None, old_obj_name=None, new_obj_name=None):
-        self._logs = defaultdict(list)
-        if os.path.exists('logs.csv') == False:
-            self._update_logs()
-            pd.DataFrame(self._logs).to_csv('logs.csv', sep='\t', index=False)
-
-        df = pd.read_csv('logs.csv', sep='\t')
-        self._logs = df.to_dict('list') if len(df) else defaultdict(list) 
-        
-        if operation is not None and old_obj_name is not None and new_obj_name is not None:
-            self._update_logs(operation, old_obj_name, new_obj_name)
-            df = pd.DataFrame.from_dict(self._logs)
-            df.to_csv('logs.csv', sep='\t', index=False)
+        # appends the decision on the current point to the audit log
+        if operation is not None and self.current_point is not None:
+            operation_log.append(self.run_name, self.user_id, self.all_points.locations(self.current_point),
+                                 operation, old_obj_name, new_obj_name)
     
     
-    def handle_accept(self):
+    def handle_accept(self, store=True):
+        # returns the object whose picks changed, None if the point already was accepted
         if self.current_point is not None:
-            self.picked_points_mask[self.current_point] = 1
-            obj_name = self._point_types[self.current_point]
-            print(f"Accept, Object Type: {obj_name}, Run Name: {self.run_name}, Location: {self.current_point_obj.location}")
-            self._point_types[self.current_point] = obj_name
-            if self.current_point not in self._picked_id_per_obj[obj_name]:
-                self._picked_id_per_obj[obj_name].append(self.current_point)
-                self._picked_points_per_obj[obj_name].append(self.current_point_obj)
-            self._store_points(obj_name)
+            x, y, z = self.all_points.locations(self.current_point)
+            print(f"Accept, Object Type: {self._decisions.class_name(self.current_point)}, Run Name: {self.run_name}, Location: x={x} y={y} z={z}")
+            obj_name = self._decisions.accept(self.current_point)
+            if store and obj_name is not None:
+                self._store_points(obj_name)
+            return obj_name
 
     
-    def handle_reject(self, enable_log=True):
+    def handle_reject(self, enable_log=True, store=True):
+        # returns the object whose picks changed, None if the point was not picked
         if enable_log:
             self.log_operation(operation='reject', old_obj_name='NC', new_obj_name='NC')
 
         if self.current_point is not None:
-            self.picked_points_mask[self.current_point] = 2
-            try:
-                obj_name =self._point_types[self.current_point]
-                index = self._picked_id_per_obj[obj_name].index(self.current_point)
-                print(f'reject point index {self.current_point}, index in the list {index}')
-                self._picked_id_per_obj[obj_name].pop(index)
-                self._picked_points_per_obj[obj_name].pop(index)
+            obj_name = self._decisions.reject(self.current_point)
+            if store and obj_name is not None:
                 self._store_points(obj_name)
-            except:
-                pass
+            return obj_name
 
 
-    def handle_assign(self, new_bj_name=None):
-        self.handle_reject(enable_log=False)
+    def handle_assign(self, new_bj_name=None, store=True):
+        # returns the objects whose picks changed
+        rejected = self.handle_reject(enable_log=False, store=store)
         self.change_obj_name(new_bj_name)
-        self.handle_accept()
-        #self.picked_points_mask[self.current_point] = 3
-
-        # EXPERIMENT, dangeraous, may incurr index errors!
-        # Only re-assignment changes the original states (initialized when load run) 
-        new_list = []
-        target = tuple()
-        old_obj_name = self.pickable_obj_name
-        print(old_obj_name, self.points_per_obj[old_obj_name])
-        for item in self.points_per_obj[old_obj_name]:
-            if item[0] != self.current_point:
-                new_list.append(item)
-            else:
-                target = item
-
-        self.points_per_obj[old_obj_name] = new_list
-        # add the new assigned point to the front
-        self.points_per_obj[new_bj_name].insert(0, target)
+        accepted = self.handle_accept(store=store)
+        return [rejected, accepted]
 
         
-    
+    # Batches are applied in memory and the picks of each touched object are stored once.
+    # Gallery positions are resolved to points up front, as reassignments reorder the galleries.
+    def _batch_points(self, point_ids, obj_name):
+        return self.points_per_obj[obj_name][np.asarray(point_ids, dtype=np.int64)]
+
+
     def handle_accept_batch(self, point_ids=None, obj_name=None):
         if point_ids is not None:
-            for point_id in point_ids:
-                self.load_curr_point(point_id=point_id, obj_name=obj_name)
-                self.handle_accept()
+            touched = []
+            for point in self._batch_points(point_ids, obj_name):
+                self._set_current_point(point)
+                touched.append(self.handle_accept(store=False))
+            self._store_objects(touched)
 
 
     def handle_reject_batch(self, point_ids=None, obj_name=None):
         if point_ids is not None:
-            for point_id in point_ids:
-                self.load_curr_point(point_id=point_id, obj_name=obj_name)
-                self.handle_reject()
+            touched = []
+            for point in self._batch_points(point_ids, obj_name):
+                self._set_current_point(point)
+                touched.append(self.handle_reject(store=False))
+            self._store_objects(touched)
     
     
     def handle_assign_batch(self, point_ids=None, obj_name=None, new_bj_name=None):
         if point_ids is not None and obj_name is not None and new_bj_name is not None:
-            for point_id in point_ids:
-                self.load_curr_point(point_id=point_id, obj_name=obj_name)
-                self.handle_assign(new_bj_name)
+            touched = []
+            for point in self._batch_points(point_ids, obj_name):
+                self._set_current_point(point)
+                touched += self.handle_assign(new_bj_name, store=False)
+            self._store_objects(touched)
+
+
+
+class SessionRegistry:
+    '''
+    CopickDataset of each browser session, created on first use and closed after
+    max_idle seconds without access. All sessions share the copick roots and the opened tomograms.
+    '''
+    def __init__(self, copick_config_path: str=None, copick_config_path_tomogram: str=None, max_idle: int=3600):
+        self.root = CopickRootFSSpec.from_file(copick_config_path) if copick_config_path else None
+        self.tomo_root = CopickRootFSSpec.from_file(copick_config_path_tomogram) if copick_config_path_tomogram else None
+        self.tomograms = TomogramCache()
+        self.max_idle = max_idle
+        self._sessions = dict()   # {session_id: [dataset, last access time]}
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+
+
+    def get(self, session_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                entry = [CopickDataset(root=self.root, tomo_root=self.tomo_root, tomograms=self.tomograms, session_id=session_id), now]
+                self._sessions[session_id] = entry
+            entry[1] = now
+            sweep = now - self._last_sweep > min(self.max_idle, 60)
+        if sweep:
+            self.evict_idle()
+        return entry[0]
+
+
+    def find(self, session_id):
+        # the dataset of an existing session or None, unlike get does not open a new session
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            entry[1] = time.monotonic()
+            return entry[0]
+
+
+    def evict_idle(self):
+        now = time.monotonic()
+        with self._lock:
+            self._last_sweep = now
+            idle = [session_id for session_id, (_, last_access) in self._sessions.items() if now - last_access > self.max_idle]
+            evicted = [self._sessions.pop(session_id)[0] for session_id in idle]
+        for dataset in evicted:
+            thumbnail_prefetcher.cancel(dataset)
+            dataset.close()
+        if evicted:
+            print(f'Closed {len(evicted)} idle review sessions')
+
 
+    def __len__(self):
+        return len(self._sessions)
 
 
 
-copick_dataset = CopickDataset(copick_config_path=COPICKLIVE_CONFIG_PATH, copick_config_path_tomogram=COPICK_TEMPLATE_PATH)
+sessions = SessionRegistry(copick_config_path=COPICKLIVE_CONFIG_PATH, copick_config_path_tomogram=COPICK_TEMPLATE_PATH, max_idle=SESSION_IDLE_TIMEOUT)
 
@@ -0,0 +1,117 @@
+import numpy as np
+
+
+UNASSIGNED, ACCEPTED, REJECTED = 0, 1, 2
+
+
+class DecisionStore:
+    '''
+    Review decisions on the points of a run, kept in flat arrays so that accepting, rejecting or
+    reassigning a point costs the same for classes of a hundred or of 50k candidates.
+    Per point it holds the status, the current class and a position key ordering the points of a
+    class in the gallery. The ordered point indices of a class are rebuilt lazily, once after a
+    batch of changes, and keep the relative order of the remaining points; reassigned points are
+    put in front of their new class.
+    Indexing the store with a class name returns its ordered point indices, like a dict of arrays.
+    Args:
+        objects:        class names
+        point_class:    class index (into objects) of each point
+        order:          ordered point indices of each class, {'ribosome': array([0,3,2,...]),...}
+    '''
+    def __init__(self, objects=(), point_class=None, order=None):
+        self.objects = list(objects)
+        self._class_ids = {name: i for i, name in enumerate(self.objects)}
+        self.point_class = np.array(point_class if point_class is not None else [], dtype=np.int32)
+        n = len(self.point_class)
+        self.status = np.zeros(n, dtype=np.int8)   # UNASSIGNED, ACCEPTED or REJECTED
+        self.position = np.zeros(n, dtype=np.int64)   # order of the points within their class
+        self._accepted_at = np.zeros(n, dtype=np.int64)   # keeps the stored picks in decision order
+        self._sequence = 0
+        self._front = [0]*len(self.objects)   # smallest position key of each class
+        self._orders = dict()   # {class index: ordered point indices}, dropped when the class changes
+        for name, indices in (order or {}).items():
+            indices = np.asarray(indices, dtype=np.int64)
+            self.position[indices] = np.arange(len(indices))
+            self._orders[self._class_id(name)] = indices
+
+
+    def _class_id(self, name):
+        # registers classes first seen through a reassignment
+        if name not in self._class_ids:
+            self._class_ids[name] = len(self.objects)
+            self.objects.append(name)
+            self._front.append(0)
+        return self._class_ids[name]
+
+
+    def __len__(self):
+        return len(self.point_class)
+
+
+    def __contains__(self, name):
+        return name in self._class_ids
+
+
+    def __iter__(self):
+        return iter(self.objects)
+
+
+    def __getitem__(self, name):
+        '''
+        Point indices of a class in gallery order, empty for unknown classes.
+        '''
+        if name not in self._class_ids:
+            return np.empty(0, dtype=np.int64)
+        class_id = self._class_ids[name]
+        indices = self._orders.get(class_id)
+        if indices is None:
+            members = np.flatnonzero(self.point_class == class_id)
+            indices = members[np.argsort(self.position[members], kind='stable')]
+            self._orders[class_id] = indices
+        return indices
+
+
+    def class_name(self, point):
+        return self.objects[self.point_class[point]]
+
+
+    def accept(self, point):
+        # returns the class whose accepted points changed, None if the point already was accepted
+        if self.status[point] == ACCEPTED:
+            return None
+        self.status[point] = ACCEPTED
+        self._sequence += 1
+        self._accepted_at[point] = self._sequence
+        return self.class_name(point)
+
+
+    def reject(self, point):
+        # returns the class whose accepted points changed, None if the point was not accepted
+        was_accepted = self.status[point] == ACCEPTED
+        self.status[point] = REJECTED
+        return self.class_name(point) if was_accepted else None
+
+
+    def reassign(self, point, name):
+        '''
+        Moves a point to the front of another class, keeping its status. Returns the previous class.
+        '''
+        old_id = self.point_class[point]
+        new_id = self._class_id(name)
+        if new_id != old_id:
+            self._front[new_id] -= 1
+            self.position[point] = self._front[new_id]
+            self.point_class[point] = new_id
+            self._orders.pop(old_id, None)
+            self._orders.pop(new_id, None)
+        return self.objects[old_id]
+
+
+    def accepted(self, name):
+        '''
+        Indices of the accepted points of a class, in the order they were accepted.
+        '''
+        if name not in self._class_ids:
+            return np.empty(0, dtype=np.int64)
+        members = np.flatnonzero((self.point_class == self._class_ids[name]) & (self.status == ACCEPTED))
+        return members[np.argsort(self._accepted_at[members], kind='stable')]
@@ -1,58 +1,125 @@
+import os, configparser
 import dash_bootstrap_components as dbc
 from dash import html
 import plotly.express as px
 import plotly.graph_objects as go
 
-from PIL import Image
-import io
-import base64
+import hashlib
+import threading
+from collections import OrderedDict
 import numpy as np
+from urllib.parse import quote
+from dash import get_relative_path
 
-from utils.copick_dataset import copick_dataset
-from functools import lru_cache 
+from utils.thumbnail_cache import thumbnail_cache
+from utils.thumbnail_encoder import thumbnail_encoder
 
 
+config = configparser.ConfigParser()
+config.read(os.path.join(os.getcwd(), "config.ini"))
+MAX_SCATTER_POINTS = config.getint('review', 'MAX_SCATTER_POINTS', fallback=20000)   # markers of the 3D pick view
+SCATTER_FOCUS_RADIUS = config.getfloat('review', 'SCATTER_FOCUS_RADIUS', fallback=50)   # voxels around a clicked pick shown at full resolution
+MAX_CROP_WIDTH = config.getint('review', 'MAX_CROP_WIDTH', fallback=256)   # largest thumbnail crop width in pixels
+MAX_CROP_AVG = config.getint('review', 'MAX_CROP_AVG', fallback=10)   # most neighbor layers averaged on each side
+MAX_PAGES = 256   # pages whose voxels are kept for encoding page-normalized thumbnails again
 
-def grid_inds(copick_loc, hw):
+
+
+def grid_inds(copick_loc):
     x, y, z = copick_loc.x, copick_loc.y, copick_loc.z
-    x //= 10
-    y //= 10
-    z //= 10
-    x += hw
-    y += hw
-    z += hw
-    return x, y, z
+    return int(x//10), int(y//10), int(z//10)
 
 
-def crop_image2d(image, copick_loc, hw, avg):
-    x, y, z = grid_inds(copick_loc, hw)
-    z_minus = max(int(z)-avg, hw)
-    z_plus = min(int(z)+avg+1, image.shape[0]-hw)
-    out = np.mean(image[z_minus:z_plus, int(y)-hw:int(y)+hw+1, int(x)-hw:int(x)+hw+1], axis=0)  # (z, y, x) for copick coordinates
-    return np.swapaxes(out, 1, 0)  # change back to (z, x, y) for plotting, in accordance with ChimeraX after 90 deg clockwise rotation.
+def grid_voxels(locations):
+    # vectorized grid_inds of an (N, 3) array of locations
+    return np.floor_divide(locations, 10).astype(np.int64).reshape(-1, 3)
 
 
-#====================================== memoization ======================================
-#@lru_cache(maxsize=128)  # number of images
-def prepare_images2d(run=None, particle=None, positions=[], hw=60, avg=2):
-    padded_image = np.pad(copick_dataset.tomogram, ((hw,hw), (hw,hw), (hw, hw)), 'constant')    
-    # cache_dir = CACHE_ROOT + 'cache-directory/'
-    # os.makedirs(cache_dir, exist_ok=True)
-    # # Create an LRU cache for the store with a maximum size of 100 MB
-    # store = DirectoryStore(f'{cache_dir}{run}_2d_crops.zarr')
-    # #cache_store = LRUStoreCache(store, max_size=100 * 2**20)
-    # root = zarr.group(store=store, overwrite=True)
-    cropped_image_batch = []
-    if particle in copick_dataset.points_per_obj and len(positions):
-        point_ids = [copick_dataset.points_per_obj[particle][i][0] for i in positions]
-        point_objs = [copick_dataset.all_points[id] for id in point_ids]
-        for point_obj in point_objs:
-            cropped_image = crop_image2d(padded_image, point_obj.location, hw, avg)
-            cropped_image_batch.append(cropped_image)
-        
-    return np.array(cropped_image_batch)
+def page_voxels(copick_dataset, particle, positions):
+    # voxel coordinates of the points at the given positions of a particle of a session's dataset
+    point_ids = copick_dataset.points_per_obj[particle][np.asarray(positions, dtype=np.int64)]
+    return grid_voxels(copick_dataset.all_points.locations(point_ids))
+
+
+def crop_bounds(tomogram):
+    # largest half width and number of averaged layers of the thumbnails of a tomogram
+    dim_z, dim_y, dim_x = tomogram.shape
+    return min(MAX_CROP_WIDTH, dim_x, dim_y)//2, min(MAX_CROP_AVG, dim_z//2)
+
+
+MAX_BLOCK_VOXELS = 2**23   # largest block read from the tomogram for a group of crops
 
 
+def _crop_groups(voxels, hw, avg):
+    # groups nearby points (in z order) so that each group is cropped from one block of the tomogram,
+    # a point joins a group as long as the block stays small compared to the crops it serves
+    order = np.argsort(voxels[:,2], kind='stable')
+    crop_volume = (2*avg+1) * (2*hw+1)**2
+    groups = []
+    group = []
+    lo = hi = None
+    for i in order:
+        v = voxels[i]
+        if group:
+            new_lo, new_hi = np.minimum(lo, v), np.maximum(hi, v)
+            block = np.prod(new_hi - new_lo + [2*hw+1, 2*hw+1, 2*avg+1])
+            if block <= min(4*crop_volume*(len(group)+1), MAX_BLOCK_VOXELS):
+                group.append(i)
+                lo, hi = new_lo, new_hi
+                continue
+            groups.append(group)
+        group = [i]
+        lo, hi = v, v
+    if group:
+        groups.append(group)
+    return groups
+
+
+def crop_images2d(image, voxels, hw, avg):
+    '''
+    Crops the z-averaged (2*avg+1) slabs of size (2*hw+1, 2*hw+1) around many points at once,
+    zero padded where a crop leaves the volume.
+    Args:
+        image:      tomogram (z, y, x), any array supporting slicing (e.g. zarr)
+        voxels:     (N, 3) integer voxel coordinates (x, y, z)
+        hw:         half width of the crops
+        avg:        number of slices averaged on each side of the point
+    Returns:
+        contiguous float32 array (N, 2*hw+1, 2*hw+1), in the orientation of the gallery
+    '''
+    voxels = np.asarray(voxels, dtype=np.int64).reshape(-1, 3)
+    size = 2*hw + 1
+    out = np.zeros((len(voxels), size, size), dtype=np.float32)
+    dim_z, dim_y, dim_x = image.shape
+    offsets = np.arange(-hw, hw+1)
+    for group in _crop_groups(voxels, hw, avg):
+        x, y, z = voxels[group].T
+        # block covering the crops of the group, y and x are padded instead of clipped
+        Z0, Z1 = np.clip(z.min()-avg, 0, dim_z), np.clip(z.max()+avg+1, 0, dim_z)
+        Y0, Y1 = y.min()-hw, y.max()+hw+1
+        X0, X1 = x.min()-hw, x.max()+hw+1
+        if Z0 >= Z1:
+            continue
+        # cumulative sums over z, so any slab mean is a difference of two planes
+        cs = np.zeros((Z1-Z0+1, Y1-Y0, X1-X0), dtype=np.float32)
+        y0, y1 = max(Y0, 0), min(Y1, dim_y)
+        x0, x1 = max(X0, 0), min(X1, dim_x)
+        if y0 < y1 and x0 < x1:
+            np.cumsum(image[Z0:Z1, y0:y1, x0:x1], axis=0, dtype=np.float32, out=cs[1:, y0-Y0:y1-Y0, x0-X0:x1-X0])
+
+        z0 = np.clip(z-avg, Z0, Z1) - Z0
+        z1 = np.clip(z+avg+1, Z0, Z1) - Z0
+        yy = (y - Y0)[:,None,None] + offsets[None,:,None]
+        xx = (x - X0)[:,None,None] + offsets[None,None,:]
+        slab_sum = cs[z1[:,None,None], yy, xx] - cs[z0[:,None,None], yy, xx]
+        depth = np.maximum(z1 - z0, 1)[:,None,None]
+        out[group] = np.where((z1 > z0)[:,None,None], slab_sum / depth, 0)
+    return np.ascontiguousarray(out.swapaxes(1, 2))  # change back to (z, x, y) for plotting, in accordance with ChimeraX after 90 deg clockwise rotation.
+
+
+def crop_image2d(image, copick_loc, hw, avg):
+    return crop_images2d(image, [grid_inds(copick_loc)], hw, avg)[0]
+
 
 def blank_fig():
     """
@@ -95,29 +162,161 @@ def plot3d(x, y):
     pass    
 
 
-def arr2base64(image_array):
-    min_val = np.min(image_array)
-    max_val = np.max(image_array)
-    normalized_array = (image_array - min_val) / (max_val - min_val)
+def decimate_grid(xyz, budget):
+    '''
+    Summarizes points (N, 3) by the mean location of the points in each cell of a regular grid,
+    with the grid coarsened until at most budget cells are occupied.
+    Returns (centers, counts)
+    '''
+    if len(xyz) <= budget:
+        return xyz, np.ones(len(xyz), dtype=np.int64)
+    if budget <= 0:
+        return xyz[:0], np.zeros(0, dtype=np.int64)
+    lo = xyz.min(axis=0)
+    extents = np.sort(xyz.max(axis=0) - lo)[::-1]
+    # cell size filling budget cells over the axes the points spread along, so that flat or
+    # linear layouts start close to the final grid as well
+    for d in (3, 2, 1):
+        cell = max((np.prod(extents[:d]) / budget)**(1/d), 1e-6)
+        if extents[d-1] >= cell:
+            break
+    while True:
+        cells = np.floor((xyz - lo) / cell).astype(np.int64)
+        dims = cells.max(axis=0) + 1
+        keys = (cells[:,0]*dims[1] + cells[:,1])*dims[2] + cells[:,2]
+        _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        if len(counts) <= budget:
+            break
+        cell *= 1.25
+    inverse = inverse.reshape(-1)
+    centers = np.stack([np.bincount(inverse, weights=xyz[:,i]) for i in range(3)], axis=1) / counts[:,None]
+    return centers, counts
+
+
+def scatter3d_lod(dt, max_points=20000, focus=None, focus_radius=50):
+    '''
+    3D scatter of the picks of a run (copick_dataset.dt) with a bounded number of markers.
+    Every object/user group gets a share of max_points proportional to its size; groups over
+    their share are summarized on a voxel grid, marker sizes growing with the number of merged picks.
+    Picks within focus_radius of the focus location (x, y, z) are shown at full resolution, the closest
+    first and at most max_points//2 of them.
+    '''
+    fig = go.Figure()
+    n = len(dt['x'])
+    if n == 0:
+        return blank_fig()
+    xyz = np.stack([np.asarray(dt['x']), np.asarray(dt['y']), np.asarray(dt['z'])], axis=1).astype(np.float64)
+    object_names, objects = np.unique(np.asarray(dt['pickable_object_name']).astype(str), return_inverse=True)
+    user_names, users = np.unique(np.asarray(dt['user_id']).astype(str), return_inverse=True)
+    near = np.zeros(n, dtype=bool)
+    if focus is not None:
+        distances = np.sum((xyz - np.asarray(focus, dtype=np.float64))**2, axis=1)
+        inside = np.flatnonzero(distances <= focus_radius**2)
+        if len(inside) > max_points//2:
+            inside = inside[np.argpartition(distances[inside], max_points//2)[:max_points//2]]
+        near[inside] = True
+    budget = max(max_points - int(near.sum()), 0)
+
+    colors = px.colors.qualitative.Plotly
+    symbols = ['circle', 'diamond', 'square', 'cross', 'x', 'circle-open', 'diamond-open', 'square-open']
+    # rows of each object/user group
+    codes = objects.reshape(-1)*len(user_names) + users.reshape(-1)
+    order = np.argsort(codes, kind='stable')
+    group_codes, starts = np.unique(codes[order], return_index=True)
+    groups = np.split(order, starts[1:])
+    # markers of the decimated picks of each group, at most budget in total: one per group and the rest
+    # in proportion to the group sizes, or one for each of the largest groups when there are more groups than markers
+    n_far = np.array([np.count_nonzero(~near[group]) for group in groups])
+    n_groups = np.count_nonzero(n_far)
+    shares = np.zeros(len(groups), dtype=np.int64)
+    if budget >= n_groups:
+        shares[n_far > 0] = 1 + (budget - n_groups) * n_far[n_far > 0] // max(n_far.sum(), 1)
+    else:
+        shares[np.argsort(-n_far, kind='stable')[:budget]] = 1
+    for code, group, share in zip(group_codes, groups, shares):
+        i, j = divmod(int(code), len(user_names))
+        obj, user = object_names[i], user_names[j]
+        far = group[~near[group]]
+        close = group[near[group]]
+        centers, counts = decimate_grid(xyz[far], share)
+        centers = np.concatenate([centers, xyz[close]])
+        counts = np.concatenate([counts, np.ones(len(close), dtype=np.int64)])
+        fig.add_trace(go.Scatter3d(x=centers[:,0], y=centers[:,1], z=centers[:,2],
+                                   mode='markers',
+                                   name=f'{obj}, {user}',
+                                   legendgroup=obj,
+                                   customdata=counts,
+                                   hovertemplate=f'{obj}<br>{user}<br>x=%{{x:.1f}}<br>y=%{{y:.1f}}<br>z=%{{z:.1f}}<br>picks=%{{customdata}}<extra></extra>',
+                                   marker=dict(size=4 + 2*np.log2(counts),
+                                               color=colors[i % len(colors)],
+                                               symbol=symbols[j % len(symbols)],
+                                               opacity=0.5)))
+    fig.update_layout(legend_title_text='pickable_object_name, user_id', uirevision='scatter3d')
+    return fig
+
+
+#====================================== memoization ======================================
+_pages = OrderedDict()   # {page id: voxels}
+_pages_lock = threading.Lock()
 
-    # Convert the normalized array to the RGB range [0, 255]
-    rgb_array = (normalized_array * 255).astype('uint8')
-    
-    # Convert the image array to a PIL Image object
-    image = Image.fromarray(rgb_array)
 
-    # Save the image to a bytes buffer
-    buffer = io.BytesIO()
-    image.save(buffer, format='PNG')
-    image_bytes = buffer.getvalue()
+def register_page(voxels, hw, avg):
+    '''
+    Identifies a page of thumbnails when they share the contrast range of their page (NORMALIZE = page),
+    as the pixels of a point then depend on the whole page. The voxels of recent pages are kept, see page_voxels_of.
+    Returns None when every thumbnail is normalized on its own.
+    '''
+    if thumbnail_encoder.normalize != 'page':
+        return None
+    voxels = np.array(voxels, dtype=np.int64).reshape(-1, 3)
+    page = hashlib.sha1(voxels.tobytes() + repr((hw, avg)).encode()).hexdigest()[:16]
+    with _pages_lock:
+        _pages[page] = voxels
+        _pages.move_to_end(page)
+        while len(_pages) > MAX_PAGES:
+            _pages.popitem(last=False)
+    return page
 
-    # Encode the bytes in base64
-    image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-    return image_base64
 
+def page_voxels_of(page):
+    # voxels of a registered page, None if unknown or evicted
+    with _pages_lock:
+        return _pages.get(page)
 
 
-def image_card(image_arr, index=0):
+def cached_thumbnails(tomogram, tomo_key, voxels, hw, avg):
+    '''
+    Returns the encoded thumbnails (bytes) of the crops around the given voxels of a tomogram,
+    only the thumbnails missing from the cache are cropped (in one batch) and encoded.
+    '''
+    page = register_page(voxels, hw, avg)
+    keys = [(tomo_key, int(x), int(y), int(z), hw, avg, thumbnail_encoder.key, page) for x,y,z in voxels]
+    thumbnails = [thumbnail_cache.get(key) for key in keys]
+    missing = [i for i,thumbnail in enumerate(thumbnails) if thumbnail is None]
+    if missing and thumbnail_encoder.normalize == 'page':
+        # the contrast range depends on the whole page
+        missing = list(range(len(keys)))
+    if missing:
+        cropped_image_batch = crop_images2d(tomogram, voxels[missing], hw, avg)
+        for i, thumbnail in zip(missing, thumbnail_encoder.encode_batch(cropped_image_batch)):
+            thumbnails[i] = thumbnail
+            thumbnail_cache.put(keys[i], thumbnail)
+    return thumbnails
+
+
+def thumbnail_version(tomo_key):
+    # changes with the tomogram and the encoder settings, so thumbnail urls can be cached for good
+    return hashlib.sha1(repr((tomo_key, thumbnail_encoder.key)).encode()).hexdigest()[:16]
+
+
+def thumbnail_url(run, voxel, hw, avg, version, session_id, page=None):
+    # the url names the session that opened the run, and the page of page-normalized thumbnails (see register_page)
+    x, y, z = voxel
+    path = get_relative_path(f'/thumbnails/{quote(run, safe="")}/{x}_{y}_{z}_{hw}_{avg}.{thumbnail_encoder.format}')
+    return f'{path}?v={version}&s={quote(str(session_id), safe="")}' + (f'&p={page}' if page is not None else '')
+
+
+def image_card(src, index=0):
     image = html.Div(
         children=[dbc.Card(
                     id={'type': 'thumbnail-card', 'index': index},
@@ -125,7 +324,7 @@ def image_card(image_arr, index=0):
                             html.A(id={'type': 'thumbnail-image', 'index': index},
                                 n_clicks=0,   
                                 children=dbc.CardImg(id={'type': 'thumbnail-src', 'index': index},
-                                                        src=f'data:image/png;base64,{arr2base64(image_arr)}',
+                                                        src=src,
                                                         bottom=False)),
                                 #dbc.CardBody([html.P(style={'whiteSpace': 'pre-wrap', 'font-size': '12px'})])
                             ],
@@ -139,17 +338,17 @@ def image_card(image_arr, index=0):
     return image
 
 
-def draw_gallery_components(list_of_image_arr, n_rows, n_cols):
+def draw_gallery_components(list_of_thumbnails, n_rows, n_cols):
     '''
     This function display the images per page
     Args:
-        list_of_image_arr:   List of image arrays
+        list_of_thumbnails: List of image sources (thumbnail urls)
         n_rows:             Number of rows
         n_cols:             Number of columns
     Returns:
         reactivate image components
     '''
-    n_images = len(list_of_image_arr)
+    n_images = len(list_of_thumbnails)
     n_cols = n_cols
     children = []
     for j in range(n_rows):
@@ -159,15 +358,21 @@ def draw_gallery_components(list_of_image_arr, n_rows, n_cols):
             if index >= n_images:
                 # no more images, on hanging row
                 break
-            curr_image_arr = list_of_image_arr[index]
-            row_child.append(dbc.Col(image_card(curr_image_arr, j * n_cols + i), width="{}".format(12 // n_cols)))
+            curr_thumbnail = list_of_thumbnails[index]
+            row_child.append(dbc.Col(image_card(curr_thumbnail, j * n_cols + i), width="{}".format(12 // n_cols)))
         children.append(dbc.Row(row_child))
     return children
 
 
-def draw_gallery(run=None, particle=None, positions=[], hw=60, avg=2, nrow=5, ncol=4):
+def draw_gallery(copick_dataset, run=None, particle=None, positions=[], hw=60, avg=2, nrow=5, ncol=4):
     figures = []
-    cropped_image_batch = prepare_images2d(run=run, particle=particle, positions=positions, hw=hw, avg=avg)
-    if len(cropped_image_batch):
-        figures = draw_gallery_components(cropped_image_batch, nrow, ncol)
-    return figures
\ No newline at end of file
+    if particle in copick_dataset.points_per_obj and len(positions):
+        # the thumbnails are prepared in one batch and then served from the cache by the thumbnail route,
+        # only their urls go through the callback response
+        voxels = page_voxels(copick_dataset, particle, positions)
+        cached_thumbnails(copick_dataset.tomogram, copick_dataset.tomogram_key, voxels, hw, avg)
+        version = thumbnail_version(copick_dataset.tomogram_key)
+        page = register_page(voxels, hw, avg)
+        urls = [thumbnail_url(copick_dataset.run_name, voxel, hw, avg, version, copick_dataset.session_id, page) for voxel in voxels.tolist()]
+        figures = draw_gallery_components(urls, nrow, ncol)
+    return figures
@@ -1,10 +1,16 @@
-import os, pathlib, time
+import os, time, uuid
 import threading 
 
-import random, json, copy, configparser
-from collections import defaultdict, deque
+import json, copy, configparser
+from collections import defaultdict, namedtuple
+from types import MappingProxyType
 import json, zarr
 
+from utils.pick_index import PickIndex, PickScanner
+from utils.run_index import RunIndex, local_path
+from utils.task_scheduler import TaskScheduler
+from utils.task_allocator import TaskAllocator
+
 
 config = configparser.ConfigParser()
 config.read(os.path.join(os.getcwd(), "config.ini"))
@@ -12,19 +18,42 @@ COPICK_TEMPLATE_PATH = '%s' % config['copick_template']['COPICK_TEMPLATE_PATH']
 COUNTER_FILE_PATH = '%s' % config['counter_checkpoint']['COUNTER_FILE_PATH'] 
 PICK_FILE_PATH = '%s' % config['local_picks']['PICK_FILE_PATH'] + 'ExperimentRuns/'
 CACHE_ROOT = '%s' % config['local_cache']['CACHE_ROOT']
+LIVE_UPDATES_MODE = config.get('live_updates', 'MODE', fallback='auto')   # auto, events or poll
+POLL_INTERVAL = config.getint('live_updates', 'POLL_INTERVAL', fallback=20)
+RESCAN_INTERVAL = config.getint('live_updates', 'RESCAN_INTERVAL', fallback=600)
+SCAN_EXECUTOR = config.get('scanner', 'EXECUTOR', fallback='thread')   # thread, process or serial
+SCAN_WORKERS = config.getint('scanner', 'MAX_WORKERS', fallback=0)
+TASKS_DB_PATH = config.get('tasks', 'DB_PATH', fallback=os.path.join(CACHE_ROOT, 'tasks.sqlite'))   # leases of the recommended runs
+TASK_LEASE_HOURS = config.getfloat('tasks', 'LEASE_HOURS', fallback=24)   # abandoned leases are handed out again after that
+
+
+def _counter_tasks_per_person():
+    # batch size of the former counter checkpoint file
+    try:
+        with open(COUNTER_FILE_PATH) as f:
+            return int(json.load(f)['tasks_per_person'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return 10
+
+TASKS_PER_PERSON = config.getint('tasks', 'TASKS_PER_PERSON', fallback=None) or _counter_tasks_per_person()
 
-dirs = ['TS_'+str(i)+'_'+str(j) for i in range(1,2) for j in range(1,10)]
-dir2id = {j:i for i,j in enumerate(dirs)}
-dir_set = set(dirs)
 
+# immutable, versioned view of the statistics, readers always get a consistent set of fields
+StatsSnapshot = namedtuple('StatsSnapshot', ['version', 
+                                             'proteins', 
+                                             'tomograms', 
+                                             'tomos_per_person', 
+                                             'tomos_pickers', 
+                                             'num_per_person_ordered', 
+                                             'tomos_done', 
+                                             'tomos_one_pick'])
 
-# define a wrapper function
-def threaded(fn):
-    def wrapper(*args, **kwargs):
-        thread = threading.Thread(target=fn, args=args, kwargs=kwargs)
-        thread.start()
-        return thread
-    return wrapper
+
+def _update_frozen(target, key, source):
+    if source.get(key):
+        target[key] = frozenset(source[key])
+    else:
+        target.pop(key, None)
 
 
 class LocalDataset:
@@ -33,18 +62,41 @@ class LocalDataset:
         with open(config_path) as f:
             self.config_file = json.load(f)
         
-        # output
-        self.proteins = defaultdict(int) # {'ribosome': 38, ...}
-        self.tomograms = defaultdict(set)  #{'TS_1_1':{'ribosome', ...}, ...}
-        self.tomos_per_person = defaultdict(set) #{'john.doe':{'TS_1_1',...},...} 
-        self.tomos_pickers = defaultdict(set)   #{'Test_1_1': {john.doe,...}, ...}
-        self.num_per_person_ordered = dict() # {'Tom':5, 'Julie':3, ...}
+        # output, published as a StatsSnapshot, see snapshot()
+        self._snapshot = StatsSnapshot(version=0,
+                                       proteins=MappingProxyType({}), # {'ribosome': 38, ...}
+                                       tomograms=MappingProxyType({}),  #{'TS_1_1':{'ribosome', ...}, ...}
+                                       tomos_per_person=MappingProxyType({}), #{'john.doe':{'TS_1_1',...},...} 
+                                       tomos_pickers=MappingProxyType({}),   #{'Test_1_1': {john.doe,...}, ...}
+                                       num_per_person_ordered=MappingProxyType({}), # {'Tom':5, 'Julie':3, ...}
+                                       tomos_done=frozenset(),   # labeled at least by 2 people, {0, 1, 2}
+                                       tomos_one_pick=frozenset(), # labeled only by 1 person, {3,4,5,...} 
+                                      )
+
+        # hidden variables for incremental updates of the outputs, only modified under self._lock
+        self._proteins = defaultdict(int)
+        self._tomograms = defaultdict(set)
+        self._tomos_per_person = defaultdict(set)
+        self._tomos_pickers = defaultdict(set)
+        self._dirty_objs = set()  # changed since the last snapshot
+        self._dirty_runs = set()
+        self._dirty_users = set()
+        self._index = PickIndex(local_file_path, os.path.join(CACHE_ROOT, 'pick_index.json'))
+        self._scanner = PickScanner(SCAN_EXECUTOR, SCAN_WORKERS)
+        self._counted = dict()  # {'TS_1_1/Picks/john.doe_0_ribosome.json': ['TS_1_1', 'john.doe', 'ribosome', 38], ...} files counted in the outputs
+        self._files_per_run_obj = defaultdict(int)  # {('TS_1_1', 'ribosome'): 2, ...}
+        self._files_per_run_user = defaultdict(int)  # {('TS_1_1', 'john.doe'): 6, ...}
+        self._lock = threading.Lock()  # refresh() and update_files() may run in different threads
+        self._instance = uuid.uuid4().hex[:8]  # versions are only comparable within one server process
+
+        # runs discovered in the overlay and the static root (if local)
+        static_root = local_path(self.config_file.get('static_root'))
+        self.runs = RunIndex([local_file_path, os.path.join(static_root, 'ExperimentRuns') if static_root else None])
+        self.runs.refresh()
+        self._scheduler = TaskScheduler()  # runs that still need pickers, updated as picks arrive
+        self._scheduler.sync(self.runs.ids())
+        self._allocator = TaskAllocator(TASKS_DB_PATH, lease_seconds=TASK_LEASE_HOURS*3600)
         
-        # hidden variables for updating candidate recomendations 
-        self._all = set([i for i in range(len(dirs))])
-        self._tomos_done = set()   # labeled at least by 2 people, {0, 1, 2}
-        self._tomos_one_pick = set() # labeled only by 1 person, {3,4,5,...} 
-        self._candidate_dict = defaultdict() # {1:1, 2:0, ...}
         self._prepicks = set(['slab-picking', 
                              'pytom-template-match', 
                              'relion-refinement', 
@@ -64,123 +116,223 @@ class LocalDataset:
                            'colors': colors
                           }
 
-    def _reset(self):
-        self.proteins = defaultdict(int) 
-        self._tomos_one_pick = set() #may remove some elems, thereofore, empty before each check
+        with self._lock:
+            for path, summary in self._index.summaries().items():
+                self._update_file(path, summary)
+            self._publish()
 
-        xdata = []
-        colors = dict()
-        for po in self.config_file["pickable_objects"]:
-            xdata.append(po["name"])
-            colors[po["name"]] = po["color"]
-            
-        self._im_dataset = {'name': xdata, 
-                           'count': [], 
-                           'colors': colors
-                          }
-        
     
     def refresh(self):
-        self._reset()
         self._update_tomo_sts()
 
+
+    def snapshot(self) -> StatsSnapshot:
+        return self._snapshot
+
+
+    def versions(self, stats: StatsSnapshot=None) -> dict:
+        '''
+        Etags of the parts of the dashboard: the statistics, the number of runs and the waitlist.
+        A part is unchanged while its etag is.
+        '''
+        stats = stats if stats is not None else self.snapshot()
+        return {'stats': f'{self._instance}-{stats.version}',
+                'runs': f'{self._instance}-{len(self.runs)}',
+                'waitlist': f'{self._instance}-{self._scheduler.version}',
+               }
+
+
+    @property
+    def proteins(self):
+        return self._snapshot.proteins
+
+
+    @property
+    def tomograms(self):
+        return self._snapshot.tomograms
+
+
+    @property
+    def tomos_per_person(self):
+        return self._snapshot.tomos_per_person
+
+
+    @property
+    def tomos_pickers(self):
+        return self._snapshot.tomos_pickers
+
+
+    @property
+    def num_per_person_ordered(self):
+        return self._snapshot.num_per_person_ordered
+
+
+    def _count(self, summary, sign):
+        run, user, obj, n = summary
+        self._proteins[obj] += sign*n
+        self._dirty_objs.add(obj)
+        self._dirty_runs.add(run)
+        self._dirty_users.add(user)
+        
+        self._files_per_run_obj[(run, obj)] += sign
+        if self._files_per_run_obj[(run, obj)] > 0:
+            self._tomograms[run].add(obj)
+        else:
+            del self._files_per_run_obj[(run, obj)]
+            self._tomograms[run].discard(obj)
+            if not self._tomograms[run]:
+                del self._tomograms[run]
+
+        self._files_per_run_user[(run, user)] += sign
+        if self._files_per_run_user[(run, user)] > 0:
+            self._tomos_pickers[run].add(user)
+            self._tomos_per_person[user].add(run)
+        else:
+            del self._files_per_run_user[(run, user)]
+            self._tomos_pickers[run].discard(user)
+            self._tomos_per_person[user].discard(run)
+            if not self._tomos_pickers[run]:
+                del self._tomos_pickers[run]
+            if not self._tomos_per_person[user]:
+                del self._tomos_per_person[user]
+
+
+    def _update_file(self, path, summary):
+        # replace the contribution of a pick file, summary is None for deleted or invalid files
+        old_summary = self._counted.pop(path, None)
+        if old_summary is not None:
+            self._count(old_summary, -1)
+        
+        if summary is not None and \
+           summary[1] not in self._prepicks and \
+           summary[0] in self.runs and \
+           summary[3]:
+            self._count(summary, 1)
+            self._counted[path] = summary
+
     
-    @threaded
-    def _walk_dir(self, args):
-        r, s, e = args
-        for dir in dirs[s:e]:
-            dir_path = r + dir +'/Picks'
-            if os.path.exists(dir_path):
-                for json_file in pathlib.Path(dir_path).glob('*.json'):
-                    try:
-                        contents = json.load(open(json_file))
-                        if 'user_id' in contents and contents['user_id'] not in self._prepicks:
-                            if 'pickable_object_name' in contents and \
-                            'run_name' in contents and contents['run_name'] in dir_set and \
-                            'points' in contents and contents['points'] and len(contents['points']):
-                                    self.proteins[contents['pickable_object_name']] += len(contents['points'])
-                                    self.tomos_per_person[contents['user_id']].add(contents['run_name'])
-                                    self.tomograms[contents['run_name']].add(contents['pickable_object_name']) 
-                                    self.tomos_pickers[contents['run_name']].add(contents['user_id'])
-                    except: 
-                        pass
+    def _update_runs(self):
+        new_runs = set(self.runs.refresh())
+        if new_runs or len(self.runs) != len(self._scheduler):
+            self._scheduler.sync(self.runs.ids())
+        if new_runs:
+            # pick files indexed before their run was discovered
+            for path, summary in self._index.summaries().items():
+                if path not in self._counted and summary is not None and summary[0] in new_runs:
+                    self._update_file(path, summary)
+
+
+    def update_files(self, paths):
+        '''
+        Applies the changes of individual pick files, e.g. reported by filesystem events.
+        Args:
+            paths:  absolute paths of created, modified or deleted files
+        '''
+        with self._lock:
+            changes = dict()
+            for path in paths:
+                rel_path = os.path.relpath(path, self.root)
+                parts = rel_path.split(os.sep)
+                if len(parts) == 3 and parts[0] not in self.runs:
+                    self._update_runs()
+                if len(parts) == 3 and parts[0] in self.runs and parts[1] == 'Picks' and parts[2].endswith('.json'):
+                    changes.update(self._index.update_path(rel_path))
+            
+            for path, summary in changes.items():
+                self._update_file(path, summary)
+            self._publish()
                         
 
     def _update_tomo_sts(self):
         start = time.time() 
-        seg = round(len(dirs)/6)
-        args1 = (self.root, 0, seg)
-        args2 = (self.root, seg, seg*2)
-        args3 = (self.root, seg*2, seg*3)
-        args4 = (self.root, seg*3, seg*4)
-        args5 = (self.root, seg*4, seg*5)
-        args6 = (self.root, seg*5, len(dirs))
-
-        t1 = self._walk_dir(args1)
-        t2 = self._walk_dir(args2)
-        t3 = self._walk_dir(args3)
-        t4 = self._walk_dir(args4)
-        t5 = self._walk_dir(args5)
-        t6 = self._walk_dir(args6)
-
-        t1.join()
-        t2.join()
-        t3.join()
-        t4.join()
-        t5.join()
-        t6.join()
-        print(f'{time.time()-start} s to check all files')
+        with self._lock:
+            self._index.touched.clear()
+            self._update_runs()
+        listing, parsed = self._scanner.scan(self._index, list(self.runs))
+        
+        # only new, changed or deleted files contribute to the update
+        with self._lock:
+            changes = self._index.update(listing, parsed)
+            for path, summary in changes.items():
+                self._update_file(path, summary)
+            self._index.save()
+            self._publish()
+        print(f'{time.time()-start} s to check all files, {len(changes)} changed')
         
-        for tomo,pickers in self.tomos_pickers.items():
-            if len(pickers) >= 2:
-                self._tomos_done.add(dir2id[tomo])
-            elif len(pickers) == 1:
-                self._tomos_one_pick.add(dir2id[tomo])
 
-        self.num_per_person_ordered = dict(sorted(self.tomos_per_person.items(), key=lambda item: len(item[1]), reverse=True))
+    def _publish(self):
+        '''
+        Swaps in a new snapshot built from the previous one, copying only the entries that
+        changed. Called with self._lock held.
+        '''
+        if not (self._dirty_objs or self._dirty_runs or self._dirty_users):
+            return
+        prev = self._snapshot
+        proteins = dict(prev.proteins)
+        for obj in self._dirty_objs:
+            proteins[obj] = self._proteins[obj]
+
+        tomograms = dict(prev.tomograms)
+        tomos_pickers = dict(prev.tomos_pickers)
+        tomos_done = set(prev.tomos_done)
+        tomos_one_pick = set(prev.tomos_one_pick)
+        for run in self._dirty_runs:
+            _update_frozen(tomograms, run, self._tomograms)
+            _update_frozen(tomos_pickers, run, self._tomos_pickers)
+            run_id = self.runs.id(run)
+            if run in self.runs:
+                self._scheduler.update(run_id, 
+                                       pickers=len(tomos_pickers.get(run, ())), 
+                                       coverage=len(tomograms.get(run, ()))/max(len(self._im_dataset['name']), 1))
+            tomos_done.discard(run_id)
+            tomos_one_pick.discard(run_id)
+            if len(tomos_pickers.get(run, ())) >= 2:
+                tomos_done.add(run_id)
+            elif len(tomos_pickers.get(run, ())) == 1:
+                tomos_one_pick.add(run_id)
+
+        tomos_per_person = dict(prev.tomos_per_person)
+        for user in self._dirty_users:
+            _update_frozen(tomos_per_person, user, self._tomos_per_person)
+        num_per_person_ordered = dict(sorted(tomos_per_person.items(), key=lambda item: len(item[1]), reverse=True))
+
+        self._snapshot = StatsSnapshot(version=prev.version+1,
+                                       proteins=MappingProxyType(proteins),
+                                       tomograms=MappingProxyType(tomograms),
+                                       tomos_per_person=MappingProxyType(tomos_per_person),
+                                       tomos_pickers=MappingProxyType(tomos_pickers),
+                                       num_per_person_ordered=MappingProxyType(num_per_person_ordered),
+                                       tomos_done=frozenset(tomos_done),
+                                       tomos_one_pick=frozenset(tomos_one_pick),
+                                      )
+        self._dirty_objs = set()
+        self._dirty_runs = set()
+        self._dirty_users = set()
 
         
-    def _update_candidates(self, n, random_sampling=True):
-        # remove candidates that should not be considered any more
-        _candidate_dict = defaultdict() 
-        for candidate in self._candidate_dict.keys():
-            if candidate in self._tomos_done:
-                continue
-            _candidate_dict[candidate] = self._candidate_dict[candidate]
-        self._candidate_dict = _candidate_dict
-        
-        # add candidates that have been picked once
-        if len(self._candidate_dict) < n:
-            for i in self._tomos_one_pick:
-                self._candidate_dict[i] = 1
-                if len(self._candidate_dict) == n:
-                    break
-
-        # add candidates that have not been picked yet 
-        if len(self._candidate_dict) < n:
-            residuals = self._all - self._tomos_done - self._tomos_one_pick
-            residuals = deque(residuals)     
-            while residuals and len(self._candidate_dict) < n:
-                if random_sampling:
-                    new_id = random.randint(0,len(residuals))
-                    self._candidate_dict[residuals[new_id]] = 0
-                    del residuals[new_id]       
-                else:
-                    new_candidate = residuals.popleft()
-                    self._candidate_dict[new_candidate] = 0
-        
+    def candidates(self, n: int) -> dict:
+        '''
+        The next n runs to pick, {run_id: number of pickers}, see TaskScheduler.
+        '''
+        return dict(self._scheduler.waitlist(n))
+
 
-    def candidates(self, n: int, random_sampling=True) -> dict:
-        self._candidate_dict = {k:0 for k in range(n)} if not random_sampling else {k:0 for k in random.sample(range(len(dirs)), n)}
-        self._update_candidates(n, random_sampling) 
-        return {k: v for k, v in sorted(self._candidate_dict.items(), key=lambda x: x[1], reverse=True)}
+    def lease_tasks(self, user_id, n: int=TASKS_PER_PERSON) -> list:
+        '''
+        Leases a batch of n runs (names) to a user, in the order of the waitlist, see TaskAllocator.
+        '''
+        stats = self.snapshot()
+        order = [self.runs.name(run_id) for run_id in self._scheduler.order()]
+        runs = self._allocator.lease(user_id, n, order, stats.tomos_pickers)
+        self._scheduler.handed_out([self.runs.id(run) for run in runs])
+        return runs
     
     
-    def fig_data(self):
+    def fig_data(self, stats: StatsSnapshot=None):
+        stats = stats if stats is not None else self.snapshot()
         image_dataset = copy.deepcopy(self._im_dataset)
-        proteins = copy.deepcopy(self.proteins)
         for name in image_dataset['name']:
-            image_dataset['count'].append(proteins[name])
+            image_dataset['count'].append(stats.proteins.get(name, 0))
                          
         image_dataset['colors'] = {k:'rgba'+str(tuple(v)) for k,v in image_dataset['colors'].items()}
         return image_dataset
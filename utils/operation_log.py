@@ -0,0 +1,114 @@
+import os, time, configparser
+import csv
+import threading
+import pandas as pd
+
+try:
+    import fcntl   # serializes appends of several server processes, not available on windows
+except ImportError:
+    fcntl = None
+
+
+config = configparser.ConfigParser()
+config.read(os.path.join(os.getcwd(), "config.ini"))
+OPERATION_LOG_PATH = config.get('operation_log', 'PATH', fallback='logs.csv')
+OPERATION_LOG_FSYNC = config.get('operation_log', 'FSYNC', fallback='interval').lower()   # always, interval or never
+OPERATION_LOG_FSYNC_INTERVAL = config.getfloat('operation_log', 'FSYNC_INTERVAL', fallback=1.0)   # seconds between fsyncs of the interval policy
+
+COLUMNS = ['run_name', 'user_id', 'x', 'y', 'z', 'operation', 'start_class', 'end_class']
+
+
+class OperationLog:
+    '''
+    Append-only audit log of the review decisions, a tab separated file with one row per operation.
+    Every row is appended and flushed on its own, so the cost of an operation does not grow with the
+    history and concurrent writers never overwrite each other's rows.
+    Args:
+        path:           tab separated log file, created with a header on the first append
+        fsync:          'always' syncs every row to disk, 'interval' at most every fsync_interval seconds,
+                        'never' leaves it to the OS
+        fsync_interval: seconds between fsyncs of the 'interval' policy
+    '''
+    def __init__(self, path: str='logs.csv', fsync: str='interval', fsync_interval: float=1.0):
+        if fsync not in ('always', 'interval', 'never'):
+            raise ValueError(f'Unknown fsync policy {fsync}, expected always, interval or never')
+        self.path = path
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self._file = None
+        self._last_sync = 0.
+        self._lock = threading.Lock()
+
+
+    def _open(self):
+        # must hold the lock
+        if self._file is None:
+            self._file = open(self.path, 'a', newline='')
+            self._writer = csv.writer(self._file, delimiter='\t', lineterminator='\n')
+        return self._file
+
+
+    def _sync(self, force=False):
+        # must hold the lock
+        now = time.monotonic()
+        if force or self.fsync == 'always' or \
+           (self.fsync == 'interval' and now - self._last_sync >= self.fsync_interval):
+            os.fsync(self._file.fileno())
+            self._last_sync = now
+
+
+    def append(self, run_name, user_id, location, operation, start_class='NC', end_class='NC'):
+        '''
+        Appends one operation on the point at location (a copick location, or x, y, z).
+        '''
+        x, y, z = (location.x, location.y, location.z) if hasattr(location, 'x') else location
+        with self._lock:
+            f = self._open()
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if f.tell() == 0 and os.fstat(f.fileno()).st_size == 0:
+                    self._writer.writerow(COLUMNS)
+                self._writer.writerow([run_name, user_id, x, y, z, operation, start_class, end_class])
+                f.flush()   # whole rows only, before other processes may append
+                self._sync()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+
+    def flush(self):
+        # forces the rows appended so far to disk
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                self._sync(force=True)
+
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                self._sync(force=True)
+                self._file.close()
+                self._file = None
+
+
+    def query(self, run_name=None, user_id=None, operation=None):
+        '''
+        Reads the log into a DataFrame for reporting, optionally filtered by run, user and operation.
+        '''
+        self.flush()
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return pd.DataFrame(columns=COLUMNS)
+        df = pd.read_csv(self.path, sep='\t')
+        for column, value in (('run_name', run_name), ('user_id', user_id), ('operation', operation)):
+            if value is not None:
+                df = df[df[column] == value]
+        return df.reset_index(drop=True)
+
+
+
+operation_log = OperationLog(path=OPERATION_LOG_PATH,
+                             fsync=OPERATION_LOG_FSYNC,
+                             fsync_interval=OPERATION_LOG_FSYNC_INTERVAL)
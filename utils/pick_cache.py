@@ -0,0 +1,246 @@
+import os, json, hashlib
+import shutil
+import threading
+import numpy as np
+from copick.models import CopickPoint, CopickLocation
+
+
+CACHE_VERSION = 1
+PICK_COLUMNS = {'x': np.float64,
+                'y': np.float64,
+                'z': np.float64,
+                'score': np.float32,   # NaN for points without a score
+                'instance_id': np.int32,
+                'transformation': np.float64,   # (N, 4, 4)
+                'object_id': np.int32,   # index into meta['objects']
+                'user_id': np.int32,   # index into meta['users']
+                'pick_id': np.int32,   # index into meta['picks'], the source pick set
+               }
+IDENTITY = np.eye(4)
+
+
+def _file_info(pick):
+    # (size, modification time) of the file behind a pick set, None if unknown
+    fs = getattr(pick, 'fs', None)
+    path = getattr(pick, 'path', None)
+    if fs is None or path is None:
+        return None
+    try:
+        info = fs.info(path)
+    except (OSError, ValueError):
+        return None
+    mtime = info.get('mtime', info.get('LastModified', info.get('ETag')))
+    return [info.get('size'), str(mtime)] if mtime is not None else None
+
+
+def run_signature(picks):
+    '''
+    Identifies the state of the pick files of a run, None if the files can not be stat'ed.
+    '''
+    signature = []
+    for pick in picks:
+        info = _file_info(pick)
+        if info is None:
+            return None
+        signature.append([pick.pickable_object_name, pick.user_id, pick.session_id, getattr(pick, 'path')] + info)
+    return sorted(signature)
+
+
+def _file_points(pick):
+    # point dicts of a pick set read straight from its file, None if they have to come from copick.
+    # Skips validating every point into a pydantic object, and the shared copick root does not keep them.
+    if pick.meta.points:   # loaded (and possibly edited) in this process
+        return None
+    fs = getattr(pick, 'fs', None)
+    path = getattr(pick, 'path', None)
+    if fs is None or path is None:
+        return None
+    try:
+        with fs.open(path, 'r') as f:
+            return json.load(f).get('points') or []
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def materialize_picks(picks):
+    '''
+    Converts the points of all pick sets into columnar arrays.
+    Returns (columns, meta)
+    '''
+    objects = dict()   # {'ribosome': 0, ...}
+    users = dict()   # {'john.doe': 0, ...}
+    meta_picks = []
+    values = {k: [] for k in PICK_COLUMNS}
+    for pick_id, pick in enumerate(picks):
+        object_id = objects.setdefault(pick.pickable_object_name, len(objects))
+        user_id = users.setdefault(pick.user_id, len(users))
+        meta_picks.append([pick.pickable_object_name, pick.user_id, pick.session_id])
+        points = _file_points(pick)
+        if points is not None:
+            # defaults as in CopickPoint
+            locations = [point['location'] for point in points]
+            values['x'] += [location['x'] for location in locations]
+            values['y'] += [location['y'] for location in locations]
+            values['z'] += [location['z'] for location in locations]
+            scores = [point.get('score', 1.0) for point in points]
+            values['score'] += [np.nan if score is None else score for score in scores]
+            values['instance_id'] += [point.get('instance_id') or 0 for point in points]
+            values['transformation'] += [point.get('transformation_') or IDENTITY for point in points]
+        else:
+            for point in pick.points or []:
+                values['x'].append(point.location.x)
+                values['y'].append(point.location.y)
+                values['z'].append(point.location.z)
+                values['score'].append(np.nan if point.score is None else point.score)
+                values['instance_id'].append(point.instance_id or 0)
+                values['transformation'].append(IDENTITY if point.transformation_ is None else point.transformation_)
+        n_points = len(values['x']) - len(values['object_id'])
+        values['object_id'] += [object_id]*n_points
+        values['user_id'] += [user_id]*n_points
+        values['pick_id'] += [pick_id]*n_points
+
+    columns = {k: np.asarray(v, dtype=PICK_COLUMNS[k]) for k,v in values.items()}
+    columns['transformation'] = columns['transformation'].reshape(-1, 4, 4)
+    meta = {'objects': list(objects), 'users': list(users), 'picks': meta_picks, 'n': len(columns['x'])}
+    return columns, meta
+
+
+class PickCache:
+    '''
+    On-disk cache of the picks of a run as columnar .npy files under
+    <cache_root>/pick_cache/<run>/<state>/, one directory per state of the pick files of the run,
+    so a change of any pick file invalidates the cache. Cached columns are memory mapped when loaded.
+    '''
+    def __init__(self, cache_root: str=None):
+        self.cache_dir = os.path.join(cache_root, 'pick_cache') if cache_root else None
+
+
+    def _run_dir(self, run_name):
+        return os.path.join(self.cache_dir, run_name)
+
+
+    def _state_dir(self, run_name, signature):
+        state = hashlib.sha1(json.dumps([CACHE_VERSION, signature]).encode()).hexdigest()[:16]
+        return os.path.join(self._run_dir(run_name), state)
+
+
+    def _read(self, run_name, signature):
+        state_dir = self._state_dir(run_name, signature)
+        try:
+            with open(os.path.join(state_dir, 'meta.json')) as f:
+                meta = json.load(f)
+            if meta.get('version') != CACHE_VERSION or meta.get('signature') != signature:
+                return None
+            # empty arrays can not be memory mapped
+            mmap_mode = 'r' if meta['n'] else None
+            columns = {k: np.load(os.path.join(state_dir, f'{k}.npy'), mmap_mode=mmap_mode) for k in PICK_COLUMNS}
+        except (OSError, ValueError, KeyError):
+            return None
+        return columns, meta
+
+
+    def _write(self, run_name, columns, meta):
+        # the columns are written into a temporary directory that is renamed at once, so concurrent
+        # writers (threads or processes) of a run never expose partially written files
+        run_dir = self._run_dir(run_name)
+        state_dir = self._state_dir(run_name, meta['signature'])
+        if os.path.exists(os.path.join(state_dir, 'meta.json')):
+            return
+        tmp_dir = os.path.join(run_dir, f'.{os.getpid()}.{threading.get_ident()}.tmp')
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        try:
+            for k, v in columns.items():
+                np.save(os.path.join(tmp_dir, f'{k}.npy'), v)
+            with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+            try:
+                os.rename(tmp_dir, state_dir)
+            except OSError:
+                # written by another worker in the meantime
+                if not os.path.exists(os.path.join(state_dir, 'meta.json')):
+                    raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        # drop earlier states of the run, memory mapped columns stay readable on posix
+        for name in os.listdir(run_dir):
+            path = os.path.join(run_dir, name)
+            if name.startswith('.') or path == state_dir:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+    def load(self, run_name, picks):
+        '''
+        Returns (columns, meta) of the picks of a run, from the cache if it is still valid.
+        '''
+        picks = list(picks)
+        signature = run_signature(picks) if self.cache_dir else None
+        if signature is not None:
+            cached = self._read(run_name, signature)
+            if cached is not None:
+                return cached
+
+        columns, meta = materialize_picks(picks)
+        if signature is not None:
+            meta['version'] = CACHE_VERSION
+            meta['signature'] = signature
+            try:
+                self._write(run_name, columns, meta)
+            except OSError as e:
+                print(f'Failed to cache the picks of {run_name}: {e}')
+        return columns, meta
+
+
+def make_point(columns, row):
+    # copick point of a row of the columns
+    score = float(columns['score'][row])
+    point = CopickPoint(location=CopickLocation(x=float(columns['x'][row]),
+                                                y=float(columns['y'][row]),
+                                                z=float(columns['z'][row])),
+                        score=None if np.isnan(score) else score,
+                        instance_id=int(columns['instance_id'][row]))
+    transformation = columns['transformation'][row]
+    if not np.array_equal(transformation, IDENTITY):
+        point.transformation_ = transformation.tolist()
+    return point
+
+
+class PointTable:
+    '''
+    Read-only sequence of copick points backed by the pick columns, a point is only
+    materialized when it is accessed.
+    Args:
+        columns:    pick columns
+        rows:       rows of the columns in the table
+    '''
+    def __init__(self, columns=None, rows=None):
+        self.columns = columns
+        self.rows = rows if rows is not None else []
+
+
+    def __len__(self):
+        return len(self.rows)
+
+
+    def __getitem__(self, index):
+        return make_point(self.columns, self.rows[index])
+
+
+    def points(self, indices):
+        # copick points of the given indices, e.g. to store them
+        rows = np.asarray(self.rows)[np.asarray(indices, dtype=np.int64)]
+        return [make_point(self.columns, row) for row in rows]
+
+
+    def locations(self, index=slice(None)):
+        # (N, 3) array of the x, y, z locations of the points, without materializing them
+        rows = np.asarray(self.rows)[index]
+        return np.stack([self.columns['x'][rows], self.columns['y'][rows], self.columns['z'][rows]], axis=-1)
@@ -0,0 +1,250 @@
+import os, re, json
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+def file_signature(st):
+    return [st.st_mtime_ns, st.st_size, st.st_ino]
+
+
+STREAM_THRESHOLD = 1 << 20   # bytes, larger pick files are summarized without parsing the points
+CHUNK_SIZE = 1 << 16
+_HEADER_FIELD = re.compile(rb'"(run_name|user_id|pickable_object_name)"\s*:\s*("(?:[^"\\]|\\.)*"|null)')
+_HEADER_OVERLAP = 1024   # longer than any header field, so fields split across chunks are found
+_POINT_KEY = b'"location"'   # exactly one per point
+
+
+def _stream_summary(path):
+    # scans the file in chunks, extracting the header fields and counting the points
+    header = dict()
+    n_points = 0
+    point_tail = b''
+    header_tail = b''
+    last = b''
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            # a tail shorter than the key can not contain it, but completes keys split across chunks
+            buf = point_tail + chunk
+            n_points += buf.count(_POINT_KEY)
+            point_tail = buf[-(len(_POINT_KEY)-1):]
+            
+            if len(header) < 3:
+                buf = header_tail + chunk
+                for match in _HEADER_FIELD.finditer(buf):
+                    header.setdefault(match.group(1).decode(), json.loads(match.group(2)))
+                header_tail = buf[-_HEADER_OVERLAP:]
+            last = (last + chunk)[-16:]
+    
+    # files being written are incomplete
+    if len(header) < 3 or not last.rstrip().endswith(b'}'):
+        return None
+    return [header['run_name'], header['user_id'], header['pickable_object_name'], n_points]
+
+
+def summarize_pick_file(path):
+    '''
+    Reads a copick pick file and returns its summary,
+    [run_name, user_id, pickable_object_name, number of points],
+    or None if the file is not a (complete) pick file.
+    Files larger than STREAM_THRESHOLD are streamed, so memory and time do not
+    depend on the size of the point list.
+    '''
+    try:
+        if os.path.getsize(path) > STREAM_THRESHOLD:
+            return _stream_summary(path)
+        with open(path) as f:
+            contents = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if not isinstance(contents, dict) or \
+       'user_id' not in contents or \
+       'pickable_object_name' not in contents or \
+       'run_name' not in contents:
+        return None
+    points = contents.get('points') or []
+    return [contents['run_name'], contents['user_id'], contents['pickable_object_name'], len(points)]
+
+
+class PickIndex:
+    '''
+    Persistent per-file index of the pick files under <root>/<run>/Picks/*.json.
+    Each entry maps a path relative to root to the file signature (mtime, size, inode)
+    and the parsed summary, so that only new or changed files need to be re-read.
+    '''
+    def __init__(self, root: str=None, index_path: str=None):
+        self.root = root
+        self.index_path = index_path
+        self.entries = dict()  # {'TS_1_1/Picks/john.doe_0_ribosome.json': [[mtime_ns, size, inode], summary], ...}
+        self.touched = set()   # paths updated by update_path() since the last full scan started
+        self._modified = False
+        self.load()
+
+
+    def load(self):
+        if self.index_path is None or not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path) as f:
+                contents = json.load(f)
+            if contents.get('root') == self.root:
+                self.entries = contents['entries']
+        except (OSError, ValueError, KeyError):
+            self.entries = dict()
+
+
+    def save(self):
+        if self.index_path is None or not self._modified:
+            return
+        os.makedirs(os.path.dirname(self.index_path) or '.', exist_ok=True)
+        tmp_path = f'{self.index_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'root': self.root, 'entries': self.entries}, f)
+        os.replace(tmp_path, self.index_path)
+        self._modified = False
+
+
+    def list_run(self, run):
+        # {relative path: signature} of all pick files of a run
+        listing = dict()
+        picks_dir = os.path.join(run, 'Picks')
+        try:
+            with os.scandir(os.path.join(self.root, picks_dir)) as it:
+                for entry in it:
+                    if entry.name.endswith('.json') and entry.is_file():
+                        listing[os.path.join(picks_dir, entry.name)] = file_signature(entry.stat())
+        except OSError:
+            pass
+        return listing
+
+
+    def changed(self, listing):
+        # paths of the listing that are new or changed since they were indexed
+        changed = []
+        for path, signature in listing.items():
+            entry = self.entries.get(path)
+            if entry is None or entry[0] != signature:
+                changed.append(path)
+        return changed
+
+
+    def update(self, listing, parsed):
+        '''
+        Updates the index with a complete listing of the pick files and the summaries of the
+        new or changed ones. Returns the changes as {path: summary}, with None for deleted files.
+        '''
+        changes = dict()
+        for path in list(self.entries):
+            if path not in listing and path not in self.touched:
+                del self.entries[path]
+                changes[path] = None
+        for path, summary in parsed.items():
+            # files updated while scanning are more recent than the listing
+            if path not in self.touched:
+                self.entries[path] = [listing[path], summary]
+                changes[path] = summary
+        if changes:
+            self._modified = True
+        return changes
+
+
+    def update_path(self, path):
+        '''
+        Re-checks a single pick file, e.g. after a filesystem event.
+        Returns the change as {path: summary}, with None for a deleted file, or {} if unchanged.
+        '''
+        self.touched.add(path)
+        try:
+            signature = file_signature(os.stat(os.path.join(self.root, path)))
+        except OSError:
+            signature = None
+        
+        entry = self.entries.get(path)
+        if signature is None:
+            if entry is None:
+                return dict()
+            del self.entries[path]
+            self._modified = True
+            return {path: None}
+        
+        if entry is not None and entry[0] == signature:
+            return dict()
+        summary = summarize_pick_file(os.path.join(self.root, path))
+        self.entries[path] = [signature, summary]
+        self._modified = True
+        return {path: summary}
+
+
+    def summaries(self):
+        return {path: entry[1] for path, entry in self.entries.items()}
+
+
+class PickScanner:
+    '''
+    Scans the pick files of a PickIndex. Directories are listed by a thread pool (one task per
+    run), the new or changed files are parsed by a configurable executor (one task per file),
+    so idle workers keep taking files until none are left. Results are returned to the caller
+    and merged there, workers never share mutable state.
+    Args:
+        executor:       'thread' for I/O bound scans (e.g. remote mounts), 'process' for CPU bound
+                        parsing of large pick files, 'serial' to parse in the calling thread
+        max_workers:    number of workers, 0 for a default based on the number of cores
+    '''
+    def __init__(self, executor: str='thread', max_workers: int=0):
+        self.executor = executor
+        cpus = os.cpu_count() or 1
+        self.max_workers = max_workers if max_workers > 0 else (cpus if executor == 'process' else min(32, cpus + 4))
+        self._list_pool = ThreadPoolExecutor(max_workers=min(32, cpus + 4), thread_name_prefix='pick-list')
+        self._parse_pool = self._new_parse_pool()
+
+
+    def _new_parse_pool(self):
+        if self.executor == 'process':
+            # fork the workers now, before the app starts its threads
+            if 'fork' in multiprocessing.get_all_start_methods():
+                pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('fork'))
+                pool.submit(os.getpid).result()
+                return pool
+            print('Process pool needs the fork start method, parsing pick files with threads')
+            self.executor = 'thread'
+        if self.executor == 'thread':
+            return ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='pick-parse')
+        return None
+
+
+    def _parse(self, paths):
+        if self._parse_pool is None or len(paths) < 2:
+            return [summarize_pick_file(path) for path in paths]
+        if self.executor == 'process':
+            # small chunks keep the workers balanced while amortizing the IPC
+            chunksize = max(1, len(paths) // (self.max_workers*8))
+            try:
+                return list(self._parse_pool.map(summarize_pick_file, paths, chunksize=chunksize))
+            except BrokenProcessPool:
+                print('Pick parsing workers died, parsing in the calling thread')
+                self._parse_pool = None
+                return [summarize_pick_file(path) for path in paths]
+        return list(self._parse_pool.map(summarize_pick_file, paths))
+
+
+    def scan(self, index, runs):
+        '''
+        Lists the pick files of the given runs and parses the new or changed ones.
+        Returns ({path: signature}, {path: summary})
+        '''
+        listing = dict()
+        for run_listing in self._list_pool.map(index.list_run, runs):
+            listing.update(run_listing)
+        changed = index.changed(listing)
+        summaries = self._parse([os.path.join(index.root, path) for path in changed])
+        return listing, dict(zip(changed, summaries))
+
+
+    def shutdown(self):
+        self._list_pool.shutdown(wait=False)
+        if self._parse_pool is not None:
+            self._parse_pool.shutdown(wait=False)
@@ -0,0 +1,139 @@
+import os
+import threading
+from apscheduler.schedulers.background import BackgroundScheduler
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+
+# inotify and friends do not report changes made by other hosts on these filesystems
+NETWORK_FILESYSTEMS = set(['nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'afs', '9p',
+                           'lustre', 'gpfs', 'beegfs', 'ceph', 'glusterfs',
+                           'fuse.sshfs', 'fuse.s3fs', 'fuse.rclone', 'fuse.ceph', 'fuse.glusterfs'])
+
+
+def filesystem_type(path):
+    # type of the filesystem mounted at the longest mount point containing path, None if unknown
+    path = os.path.realpath(path)
+    fs_type = None
+    mount_len = -1
+    try:
+        with open('/proc/mounts') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1].replace('\\040', ' ')
+                if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) and len(mount_point) > mount_len:
+                    fs_type = fields[2]
+                    mount_len = len(mount_point)
+    except OSError:
+        pass
+    return fs_type
+
+
+def supports_events(path):
+    return Observer is not None and filesystem_type(path) not in NETWORK_FILESYSTEMS
+
+
+class PickEventHandler(FileSystemEventHandler):
+    '''
+    Collects the pick files touched by filesystem events and applies them to the dataset in
+    batches, so that the bursts of events of a single save are handled at once.
+    '''
+    def __init__(self, dataset, delay: float=0.2):
+        self.dataset = dataset
+        self.delay = delay
+        self._pending = set()
+        self._timer = None
+        self._lock = threading.Lock()
+
+
+    def on_any_event(self, event):
+        if event.is_directory or event.event_type not in ('created', 'modified', 'moved', 'deleted', 'closed'):
+            return
+        with self._lock:
+            for path in (event.src_path, getattr(event, 'dest_path', None)):
+                if path and path.endswith('.json'):
+                    self._pending.add(path)
+            if self._pending and self._timer is None:
+                self._timer = threading.Timer(self.delay, self._flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+
+    def _flush(self):
+        with self._lock:
+            paths = self._pending
+            self._pending = set()
+            self._timer = None
+        try:
+            self.dataset.update_files(paths)
+        except Exception as e:
+            print(f'Failed to apply pick file events: {e}')
+
+
+class LiveUpdates:
+    '''
+    Keeps a LocalDataset up to date, either from filesystem events (with a slow full rescan
+    as a safety net for missed events) or by polling with dataset.refresh().
+    Args:
+        dataset:            LocalDataset
+        mode:               'auto' uses events where the filesystem supports them, 'events' or 'poll'
+        interval:           polling interval in seconds
+        rescan_interval:    full rescan interval in seconds in event mode, 0 disables it
+    '''
+    def __init__(self, dataset, mode: str='auto', interval: int=20, rescan_interval: int=600):
+        self.dataset = dataset
+        self.mode = mode
+        self.interval = interval
+        self.rescan_interval = rescan_interval
+        self.observer = None
+        self.scheduler = BackgroundScheduler() # in-memory job stores
+
+
+    def _start_observer(self):
+        if self.mode == 'poll' or Observer is None:
+            return False
+        if self.mode == 'auto' and not supports_events(self.dataset.root):
+            return False
+        try:
+            observer = Observer()
+            observer.schedule(PickEventHandler(self.dataset), self.dataset.root, recursive=True)
+            observer.daemon = True
+            observer.start()
+        except OSError as e:
+            # e.g. out of inotify watches
+            print(f'Filesystem events unavailable ({e}), falling back to polling')
+            return False
+        self.observer = observer
+        return True
+
+
+    def start(self):
+        if self._start_observer():
+            print(f'Watching {self.dataset.root} for pick file changes')
+            if self.rescan_interval:
+                self.scheduler.add_job(func=self.dataset.refresh, trigger='interval', seconds=self.rescan_interval)
+        else:
+            print(f'Polling {self.dataset.root} every {self.interval} s')
+            self.scheduler.add_job(func=self.dataset.refresh, trigger='interval', seconds=self.interval)
+        self.scheduler.start()
+        return self
+
+
+    def stop(self):
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+            self.observer = None
+        if self.scheduler.running:
+            self.scheduler.shutdown(wait=False)
+
+
+def start_live_updates(dataset, mode='auto', interval=20, rescan_interval=600):
+    return LiveUpdates(dataset, mode, interval, rescan_interval).start()
@@ -0,0 +1,94 @@
+import os, re
+
+
+def natural_key(name):
+    # 'TS_1_9' < 'TS_1_10'
+    return [int(t) if t.isdigit() else t for t in re.split(r'(\d+)', name)]
+
+
+def local_path(url):
+    # copick roots are fsspec urls, only local ones can be listed
+    if not url:
+        return None
+    if url.startswith('local://'):
+        return url[len('local://'):]
+    if '://' in url:
+        return None
+    return url
+
+
+class RunIndex:
+    '''
+    Runs discovered from one or more ExperimentRuns directories.
+    Ids are assigned in order of discovery (natural order within a refresh) and are never
+    changed or reused, so they stay stable across refreshes. A root is only listed again
+    when its mtime changes, i.e. when runs were added or removed.
+    '''
+    def __init__(self, roots: list=None):
+        self.roots = [root for root in roots or [] if root]
+        self.names = []   # ['TS_1_1', 'TS_1_2', ...], the position is the run id
+        self._ids = dict()   # {'TS_1_1': 0, ...}
+        self._present = set()   # runs found in the last refresh
+        self._listings = dict()   # {root: [mtime_ns, {'TS_1_1', ...}], ...}
+
+
+    def refresh(self):
+        '''
+        Re-lists the roots that changed. Returns the names of newly discovered runs.
+        '''
+        changed = False
+        for root in self.roots:
+            try:
+                mtime = os.stat(root).st_mtime_ns
+            except OSError:
+                mtime = None
+            if root in self._listings and self._listings[root][0] == mtime:
+                continue
+
+            names = set()
+            if mtime is not None:
+                try:
+                    with os.scandir(root) as it:
+                        names = set([entry.name for entry in it if entry.is_dir() and not entry.name.startswith('.')])
+                except OSError:
+                    pass
+            self._listings[root] = [mtime, names]
+            changed = True
+
+        if not changed:
+            return []
+        present = set()
+        for _, names in self._listings.values():
+            present |= names
+        new_names = sorted(present - self._ids.keys(), key=natural_key)
+        for name in new_names:
+            self._ids[name] = len(self.names)
+            self.names.append(name)
+        self._present = present
+        return new_names
+
+
+    def __len__(self):
+        return len(self._present)
+
+
+    def __contains__(self, name):
+        return name in self._present
+
+
+    def __iter__(self):
+        # present runs in id order
+        present = self._present
+        return (name for name in self.names if name in present)
+
+
+    def id(self, name):
+        return self._ids[name]
+
+
+    def name(self, run_id):
+        return self.names[run_id]
+
+
+    def ids(self):
+        return [self._ids[name] for name in self]
@@ -0,0 +1,86 @@
+import uuid
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+
+MAX_JOBS = 64   # finished jobs kept for status queries
+
+
+class RunLoader:
+    '''
+    Loads runs into the CopickDataset of a session in background workers, so that a slow load
+    (e.g. over VPN) does not block a server worker. Jobs report their progress, which the UI polls
+    with status(). A dataset holds one run at a time: loads of a session run one after the other, and a new
+    load supersedes the ones that did not start yet, so an older run never replaces a newer one.
+    Args:
+        max_workers:    number of runs loaded concurrently (by different sessions)
+    '''
+    def __init__(self, max_workers: int=4):
+        self._jobs = OrderedDict()   # {job_id: {'run': 'TS_1_1', 'state': 'queued', 'progress': 0, 'message': ''}}
+        self._futures = dict()   # {job_id: [dataset, future]} of unfinished jobs
+        self._serial = weakref.WeakKeyDictionary()   # {dataset: [lock held while loading, latest job id]}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='run-loader')
+
+
+    def _update(self, job_id, **kwargs):
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(kwargs)
+
+
+    def _load(self, job_id, copick_dataset, run_name, kwargs):
+        serial = self._serial[copick_dataset]
+        try:
+            with serial[0]:
+                # waits for a running load of the session, then skips unless still the latest one
+                if serial[1] != job_id:
+                    self._update(job_id, state='cancelled', message='Superseded')
+                    return
+                self._update(job_id, state='loading')
+                def progress(fraction, message):
+                    self._update(job_id, progress=round(100*fraction), message=message)
+                try:
+                    copick_dataset.load_curr_run(run_name=run_name, progress=progress, **kwargs)
+                except Exception as e:
+                    print(f'Failed to load {run_name}: {e}')
+                    self._update(job_id, state='failed', message=f'Failed to load {run_name}: {e}')
+                else:
+                    self._update(job_id, state='ready', progress=100, message='Ready')
+        finally:
+            with self._lock:
+                self._futures.pop(job_id, None)
+
+
+    def submit(self, copick_dataset, run_name, **kwargs):
+        '''
+        Schedules loading a run into a session's dataset, kwargs are passed to load_curr_run. Returns the job id.
+        '''
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            for pending_id, (dataset, future) in list(self._futures.items()):
+                if dataset is copick_dataset and future.cancel():
+                    self._jobs[pending_id].update(state='cancelled', message='Superseded')
+                    del self._futures[pending_id]
+            self._serial.setdefault(copick_dataset, [threading.Lock(), None])[1] = job_id
+            # forget the oldest finished jobs, unfinished ones are still polled
+            finished = [old_id for old_id in self._jobs if old_id not in self._futures]
+            for old_id in finished[:len(self._jobs) + 1 - MAX_JOBS]:
+                del self._jobs[old_id]
+            self._jobs[job_id] = {'run': run_name, 'state': 'queued', 'progress': 0, 'message': 'Waiting'}
+            self._futures[job_id] = [copick_dataset, self._executor.submit(self._load, job_id, copick_dataset, run_name, kwargs)]
+        return job_id
+
+
+    def status(self, job_id):
+        # copy of the job state, None for unknown jobs
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+
+
+run_loader = RunLoader()
@@ -0,0 +1,95 @@
+import os, time
+import sqlite3
+import threading
+
+from utils.task_scheduler import REQUIRED_PICKERS
+
+
+class TaskAllocator:
+    '''
+    Leases batches of runs to users. Leases live in a SQLite database, and every hand-out is one
+    write transaction, so concurrent requests of several server processes never hand out the
+    same slot twice. A run is leased until required_pickers users either picked it or hold an
+    unexpired lease on it. Leases of users who did not pick the run before the lease expired are
+    abandoned, and the run is handed out again.
+    Args:
+        path:               SQLite database file, on a local filesystem (SQLite locking is unreliable on NFS)
+        lease_seconds:      time a user has to pick a leased run
+        required_pickers:   users that have to pick a run
+    '''
+    def __init__(self, path: str, lease_seconds: float=24*3600, required_pickers: int=REQUIRED_PICKERS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.required_pickers = required_pickers
+        self._local = threading.local()   # one connection per thread
+
+
+    def _connection(self):
+        con = getattr(self._local, 'con', None)
+        if con is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            con = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('PRAGMA synchronous=NORMAL')
+            con.execute('CREATE TABLE IF NOT EXISTS leases (user_id TEXT NOT NULL, run_name TEXT NOT NULL, '
+                        'leased_at REAL NOT NULL, expires_at REAL NOT NULL, PRIMARY KEY (user_id, run_name))')
+            con.execute('CREATE INDEX IF NOT EXISTS leases_expiry ON leases (expires_at)')
+            self._local.con = con
+        return con
+
+
+    def lease(self, user_id, n, candidates, pickers):
+        '''
+        Leases up to n runs to a user. Runs the user still holds unexpired leases on are returned
+        again (e.g. after a second click), with their leases renewed, and topped up to n with new runs.
+        Args:
+            candidates: run names in order of preference
+            pickers:    users who picked each run, {'TS_1_1': {'john.doe', ...}, ...}
+        Returns:
+            leased run names, the open leases of the user first
+        '''
+        now = time.time()
+        con = self._connection()
+        con.execute('BEGIN IMMEDIATE')   # serializes hand-outs across threads and processes
+        try:
+            con.execute('DELETE FROM leases WHERE expires_at < ?', (now - self.lease_seconds,))   # long abandoned
+            active = con.execute('SELECT user_id, run_name FROM leases WHERE expires_at > ?', (now,)).fetchall()
+            # a lease counts until it expires or its user picked the run, then the picks count instead
+            load = dict()
+            held = []
+            for user, run in active:
+                if user in pickers.get(run, ()):
+                    continue
+                load[run] = load.get(run, 0) + 1
+                if user == user_id:
+                    held.append(run)
+
+            leased = held[:n]
+            for run in leased:
+                con.execute('UPDATE leases SET expires_at = ? WHERE user_id = ? AND run_name = ?', (now + self.lease_seconds, user_id, run))
+            for run in candidates:
+                if len(leased) >= n:
+                    break
+                if run in held or user_id in pickers.get(run, ()):
+                    continue
+                if len(pickers.get(run, ())) + load.get(run, 0) < self.required_pickers:
+                    leased.append(run)
+                    con.execute('INSERT OR REPLACE INTO leases VALUES (?, ?, ?, ?)', (user_id, run, now, now + self.lease_seconds))
+            con.execute('COMMIT')
+        except BaseException:
+            con.execute('ROLLBACK')
+            raise
+        return leased
+
+
+    def leases(self, user_id=None):
+        '''
+        Unexpired leases as [(user_id, run_name, leased_at, expires_at), ...], e.g. for reporting.
+        '''
+        query = 'SELECT user_id, run_name, leased_at, expires_at FROM leases WHERE expires_at > ?'
+        args = (time.time(),)
+        if user_id is not None:
+            query += ' AND user_id = ?'
+            args += (user_id,)
+        return self._connection().execute(query + ' ORDER BY leased_at', args).fetchall()
@@ -0,0 +1,153 @@
+import time, random
+import heapq
+import threading
+
+
+REQUIRED_PICKERS = 2   # a run is done once that many users picked it
+
+
+class TaskScheduler:
+    '''
+    Orders the runs that still need pickers, the runs are then leased in this order by a
+    TaskAllocator and reported back with handed_out. The order is kept in a
+    heap that is updated per run as picks arrive, so the waitlist is not rebuilt from all runs on
+    every refresh. Runs come first when
+        - they were picked by more users already (closest to done),
+        - they were handed out fewer times, and longer ago,
+        - fewer of the pickable objects were picked in them,
+    then by run id (or a random but fixed order).
+    Args:
+        required_pickers:   users that have to pick a run before it leaves the queue
+        random_order:       break ties in a random instead of the run id order
+    '''
+    def __init__(self, required_pickers: int=REQUIRED_PICKERS, random_order: bool=False):
+        self.required_pickers = required_pickers
+        self.random_order = random_order
+        self._runs = dict()   # {run_id: [pickers, coverage, assignments, last assignment time, tie breaker]}
+        self._keys = dict()   # {run_id: key}, only runs in the queue
+        self._heap = []   # [(key, run_id), ...], entries whose key is not in self._keys are stale
+        self._version = 0
+        self._waitlist = (None, None, [])   # (version, n, [(run_id, pickers), ...])
+        self._lock = threading.Lock()
+
+
+    def _push(self, run_id):
+        # must hold the lock
+        pickers, coverage, assignments, last_assigned, tie = self._runs[run_id]
+        if pickers >= self.required_pickers:
+            self._keys.pop(run_id, None)
+        else:
+            key = (-pickers, assignments, last_assigned, coverage, tie)
+            self._keys[run_id] = key
+            heapq.heappush(self._heap, (key, run_id))
+        if len(self._heap) > 2*len(self._keys) + 64:
+            # drop stale entries
+            self._heap = [(key, run_id) for run_id, key in self._keys.items()]
+            heapq.heapify(self._heap)
+        self._version += 1
+
+
+    def _update(self, run_id, pickers=0, coverage=0.):
+        # must hold the lock
+        state = self._runs.get(run_id)
+        if state is None:
+            tie = random.random() if self.random_order else run_id
+            self._runs[run_id] = [pickers, coverage, 0, 0., tie]
+        elif state[:2] == [pickers, coverage]:
+            return
+        else:
+            state[:2] = [pickers, coverage]
+        self._push(run_id)
+
+
+    def update(self, run_id, pickers=0, coverage=0.):
+        '''
+        Adds a run or updates the number of users who picked it and the fraction of the pickable objects picked in it.
+        '''
+        with self._lock:
+            self._update(run_id, pickers, coverage)
+
+
+    def _remove(self, run_id):
+        # must hold the lock
+        if self._runs.pop(run_id, None) is not None:
+            self._keys.pop(run_id, None)
+            self._version += 1
+
+
+    def remove(self, run_id):
+        with self._lock:
+            self._remove(run_id)
+
+
+    def sync(self, run_ids):
+        # adds missing runs and removes runs that are gone
+        run_ids = set(run_ids)
+        with self._lock:
+            for run_id in set(self._runs) - run_ids:
+                self._remove(run_id)
+            for run_id in run_ids - set(self._runs):
+                self._update(run_id)
+
+
+    def __len__(self):
+        return len(self._runs)
+
+
+    @property
+    def version(self):
+        # increases whenever the order of the queue may have changed
+        return self._version
+
+
+    def _first(self, n):
+        # must hold the lock, the first n queued runs in order
+        first, popped = [], dict()
+        while self._heap and len(first) < n:
+            key, run_id = heapq.heappop(self._heap)
+            if self._keys.get(run_id) != key or run_id in popped:
+                continue
+            popped[run_id] = key
+            first.append(run_id)
+        for run_id, key in popped.items():
+            heapq.heappush(self._heap, (key, run_id))
+        return first
+
+
+    def waitlist(self, n):
+        '''
+        The first n runs of the queue as [(run_id, pickers), ...], cached until the queue changes.
+        '''
+        with self._lock:
+            version, cached_n, runs = self._waitlist
+            if version != self._version or cached_n != n:
+                runs = [(run_id, self._runs[run_id][0]) for run_id in self._first(n)]
+                self._waitlist = (self._version, n, runs)
+            return runs
+
+
+    def order(self):
+        '''
+        All queued runs in order, unlike waitlist not cached, e.g. to lease runs from.
+        '''
+        with self._lock:
+            return self._first(len(self._keys))
+
+
+    def _handed_out(self, run_ids):
+        # must hold the lock
+        now = time.time()
+        for run_id in run_ids:
+            state = self._runs.get(run_id)
+            if state is not None:
+                state[2] += 1
+                state[3] = now
+                self._push(run_id)
+
+
+    def handed_out(self, run_ids):
+        '''
+        Records runs handed out (leased by a TaskAllocator), they move back in the queue.
+        '''
+        with self._lock:
+            self._handed_out(run_ids)
@@ -0,0 +1,120 @@
+import os, hashlib, configparser
+import threading
+from collections import OrderedDict
+
+
+config = configparser.ConfigParser()
+config.read(os.path.join(os.getcwd(), "config.ini"))
+CACHE_ROOT = '%s' % config['local_cache']['CACHE_ROOT']
+THUMBNAIL_CACHE_MB = config.getint('local_cache', 'THUMBNAIL_CACHE_MB', fallback=64)
+THUMBNAIL_DISK_CACHE_MB = config.getint('local_cache', 'THUMBNAIL_DISK_CACHE_MB', fallback=0)   # 0 disables the disk tier
+
+
+class ThumbnailCache:
+    '''
+    Two-tier cache of encoded thumbnails (image file bytes).
+    Entries are keyed by (tomogram key, x, y, z, hw, avg, ...), where the tomogram key changes
+    whenever the tomogram does, so stale thumbnails are never hit and age out.
+    Args:
+        max_bytes:      size limit of the in-memory LRU tier
+        cache_dir:      directory of the on-disk tier, None disables it
+        max_disk_bytes: size limit of the on-disk tier, least recently written files are removed first
+    '''
+    def __init__(self, max_bytes: int=64*2**20, cache_dir: str=None, max_disk_bytes: int=0):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir if cache_dir and max_disk_bytes > 0 else None
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = OrderedDict()  # {key: thumbnail}, least recently used first
+        self._size = 0
+        self._disk_size = 0
+        self._lock = threading.Lock()
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with os.scandir(self.cache_dir) as it:
+                self._disk_size = sum(entry.stat().st_size for entry in it if entry.is_file())
+
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(repr(key).encode()).hexdigest())
+
+
+    def _put_memory(self, key, thumbnail):
+        with self._lock:
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key))
+            self._entries[key] = thumbnail
+            self._size += len(thumbnail)
+            while self._size > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+
+    def get(self, key):
+        with self._lock:
+            thumbnail = self._entries.get(key)
+            if thumbnail is not None:
+                self._entries.move_to_end(key)
+                return thumbnail
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                thumbnail = f.read()
+        except OSError:
+            return None
+        self._put_memory(key, thumbnail)
+        return thumbnail
+
+
+    def put(self, key, thumbnail):
+        self._put_memory(key, thumbnail)
+        if self.cache_dir is None:
+            return
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(thumbnail)
+            try:
+                replaced = os.stat(path).st_size
+            except OSError:
+                replaced = 0
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        with self._lock:
+            self._disk_size += len(thumbnail) - replaced
+            evict = self._disk_size > self.max_disk_bytes
+        if evict:
+            self._evict_disk()
+
+
+    def _evict_disk(self):
+        # removes the oldest files until the disk tier is at 90% of its limit
+        with os.scandir(self.cache_dir) as it:
+            files = sorted([(entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in it if entry.is_file()])
+        size = sum(f[1] for f in files)
+        for _, file_size, path in files:
+            if size <= 0.9*self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+                size -= file_size
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_size = size
+
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()
+            self._size = 0
+
+
+
+thumbnail_cache = ThumbnailCache(max_bytes=THUMBNAIL_CACHE_MB * 2**20,
+                                 cache_dir=os.path.join(CACHE_ROOT, 'thumbnails'),
+                                 max_disk_bytes=THUMBNAIL_DISK_CACHE_MB * 2**20)
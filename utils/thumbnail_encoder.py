@@ -0,0 +1,86 @@
+import os, io, configparser
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+
+
+config = configparser.ConfigParser()
+config.read(os.path.join(os.getcwd(), "config.ini"))
+THUMBNAIL_FORMAT = config.get('thumbnails', 'FORMAT', fallback='png').lower()   # png, jpeg or webp
+THUMBNAIL_QUALITY = config.getint('thumbnails', 'QUALITY', fallback=85)   # jpeg and webp only
+PNG_COMPRESS_LEVEL = config.getint('thumbnails', 'PNG_COMPRESS_LEVEL', fallback=1)   # 0-9, PIL's default is 6
+THUMBNAIL_NORMALIZE = config.get('thumbnails', 'NORMALIZE', fallback='image').lower()   # contrast range per image or per page
+ENCODE_WORKERS = config.getint('thumbnails', 'ENCODE_WORKERS', fallback=min(4, os.cpu_count() or 1))   # 1 encodes in the calling thread
+
+MIME_TYPES = {'png': 'image/png', 'jpeg': 'image/jpeg', 'webp': 'image/webp'}
+
+
+def normalize_batch(images, per_page=False):
+    '''
+    Scales a batch of images (N, H, W) to uint8 in one pass, with the contrast range of each
+    image or the range shared by the whole page.
+    '''
+    images = np.asarray(images, dtype=np.float32)
+    if images.size == 0:
+        return images.astype(np.uint8)
+    axes = None if per_page else (1, 2)
+    min_val = np.min(images, axis=axes, keepdims=True)
+    max_val = np.max(images, axis=axes, keepdims=True)
+    scale = np.float32(255) / np.where(max_val > min_val, max_val - min_val, np.float32(1))
+    return ((images - min_val) * scale).astype(np.uint8)
+
+
+class ThumbnailEncoder:
+    '''
+    Encodes batches of crops into image files (bytes) for the gallery.
+    Args:
+        format:         'png', 'jpeg' or 'webp'
+        quality:        quality of the lossy formats (1-100)
+        compress_level: zlib level of png, low levels are several times faster for a slightly larger payload
+        normalize:      'image' or 'page', see normalize_batch
+        workers:        number of threads encoding a batch, PIL releases the GIL while encoding
+    '''
+    def __init__(self, format: str='png', quality: int=85, compress_level: int=1, normalize: str='image', workers: int=4):
+        if format not in MIME_TYPES:
+            raise ValueError(f'Unknown thumbnail format {format}, expected one of {list(MIME_TYPES)}')
+        self.format = format
+        self.quality = quality
+        self.compress_level = compress_level
+        self.normalize = normalize
+        self.mime_type = MIME_TYPES[format]
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='thumbnail-encode') if workers > 1 else None
+
+
+    @property
+    def key(self):
+        # settings changing the decoded image, part of the thumbnail cache keys
+        return (self.format, self.quality if self.format != 'png' else None, self.normalize)
+
+
+    def _options(self):
+        if self.format == 'png':
+            return {'compress_level': self.compress_level}
+        if self.format == 'webp':
+            return {'quality': self.quality, 'method': 0}   # fastest webp encoder
+        return {'quality': self.quality}
+
+
+    def encode(self, image_uint8):
+        buffer = io.BytesIO()
+        Image.fromarray(image_uint8).save(buffer, format=self.format.upper(), **self._options())
+        return buffer.getvalue()
+
+
+    def encode_batch(self, images):
+        images = normalize_batch(images, per_page=self.normalize == 'page')
+        if self._executor is None or len(images) < 2:
+            return [self.encode(image) for image in images]
+        return list(self._executor.map(self.encode, images))
+
+
+
+thumbnail_encoder = ThumbnailEncoder(format=THUMBNAIL_FORMAT,
+                                     quality=THUMBNAIL_QUALITY,
+                                     compress_level=PNG_COMPRESS_LEVEL,
+                                     normalize=THUMBNAIL_NORMALIZE,
+                                     workers=ENCODE_WORKERS)
@@ -0,0 +1,88 @@
+import os, configparser
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.figure_utils import cached_thumbnails, grid_voxels
+
+
+config = configparser.ConfigParser()
+config.read(os.path.join(os.getcwd(), "config.ini"))
+PREFETCH_PAGES = config.getint('review', 'PREFETCH_PAGES', fallback=1)   # pages prefetched ahead of the current one, 0 disables prefetching
+
+
+class ThumbnailPrefetcher:
+    '''
+    Crops and encodes the thumbnails of the pages around the current gallery page in a
+    background worker, so that they are served from the thumbnail cache when the user
+    pages on. Every request of a session supersedes its previous one: pending work is dropped
+    and running work stops at the next page boundary.
+    Args:
+        pages_ahead:    number of pages prefetched after the current one, the previous page is prefetched as well
+    '''
+    def __init__(self, pages_ahead: int=1):
+        self.pages_ahead = pages_ahead
+        self._generations = dict()   # {session id: generation}
+        self._futures = dict()   # {session id: future}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='thumbnail-prefetch')
+
+
+    def _stale(self, key, generation):
+        return self._generations.get(key) != generation
+
+
+    def _run(self, key, generation, tomogram, tomo_key, pages, hw, avg):
+        for voxels in pages:
+            if self._stale(key, generation):
+                return
+            try:
+                cached_thumbnails(tomogram, tomo_key, voxels, hw, avg)
+            except Exception as e:
+                print(f'Failed to prefetch thumbnails: {e}')
+                return
+
+
+    def _supersede(self, key):
+        # must hold the lock
+        self._generations[key] = self._generations.get(key, 0) + 1
+        future = self._futures.pop(key, None)
+        if future is not None:
+            future.cancel()
+        return self._generations[key]
+
+
+    def prefetch(self, copick_dataset, particle, page, page_size, hw, avg):
+        '''
+        Schedules the pages after (and the page before) the given page of a particle of a session's dataset.
+        The points and the tomogram are captured now, so a run loaded in the meantime
+        can not mix into the cache.
+        '''
+        key = copick_dataset.session_id
+        with self._lock:
+            generation = self._supersede(key)
+            if self.pages_ahead <= 0 or page_size <= 0 or copick_dataset.tomogram is None or \
+               particle not in copick_dataset.points_per_obj:
+                return
+
+            point_ids = copick_dataset.points_per_obj[particle]
+            n_pages = -(-len(point_ids) // page_size)
+            pages = []
+            for p in [page+i for i in range(1, self.pages_ahead+1)] + [page-1]:
+                if 0 <= p < n_pages:
+                    ids = point_ids[p*page_size:(p+1)*page_size]
+                    pages.append(grid_voxels(copick_dataset.all_points.locations(ids)))
+            if pages:
+                self._futures[key] = self._executor.submit(self._run, key, generation, copick_dataset.tomogram,
+                                                           copick_dataset.tomogram_key, pages, hw, avg)
+
+
+    def cancel(self, copick_dataset):
+        # stops the prefetching of a session, e.g. when it opens another run or is closed
+        key = copick_dataset.session_id
+        with self._lock:
+            self._supersede(key)
+            del self._generations[key]
+
+
+
+thumbnail_prefetcher = ThumbnailPrefetcher(pages_ahead=PREFETCH_PAGES)
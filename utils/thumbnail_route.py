@@ -0,0 +1,72 @@
+import numpy as np
+from flask import request, abort, make_response
+
+from utils.copick_dataset import sessions
+from utils.figure_utils import cached_thumbnails, thumbnail_version, register_page, page_voxels_of, crop_bounds
+from utils.thumbnail_encoder import thumbnail_encoder, MIME_TYPES
+
+
+MAX_AGE = 7*24*3600   # urls carry the tomogram version, so cached responses never go stale
+
+
+def serve_thumbnail(run, name):
+    '''
+    Serves the thumbnail <x>_<y>_<z>_<hw>_<avg>.<format> of an opened run, from the thumbnail
+    cache when the gallery callback already prepared it. The url names the session (s) that
+    opened the run, and page-normalized thumbnails also name their page (p), whose thumbnails
+    are encoded together. Crop sizes the gallery does not offer and voxels without a point of
+    the run are refused.
+    '''
+    try:
+        stem, ext = name.rsplit('.', 1)
+        x, y, z, hw, avg = [int(v) for v in stem.split('_')]
+    except ValueError:
+        abort(404)
+    version = request.args.get('v')
+    # only the run opened by the requesting session can be cropped, urls of closed runs or older versions are gone
+    copick_dataset = sessions.find(request.args.get('s'))
+    if copick_dataset is None or copick_dataset.run_name != run:
+        abort(404)
+    opened = sessions.tomograms.get(run)
+    if opened is None:
+        abort(404)
+    tomogram, tomo_key = opened
+    if ext != thumbnail_encoder.format or version != thumbnail_version(tomo_key):
+        abort(404)
+    max_hw, max_avg = crop_bounds(tomogram)
+    if not (0 <= hw <= max_hw and 0 <= avg <= max_avg):
+        abort(404)
+    dim_z, dim_y, dim_x = tomogram.shape
+    if not (0 <= x < dim_x and 0 <= y < dim_y and 0 <= z < dim_z) or not copick_dataset.has_point_voxel((x, y, z)):
+        abort(404)
+
+    page = request.args.get('p')
+    voxels = np.array([[x, y, z]])
+    if thumbnail_encoder.normalize == 'page':
+        # the pixels depend on the page, the url names it
+        voxels = page_voxels_of(page)
+        if voxels is None or register_page(voxels, hw, avg) != page:
+            abort(404)
+        matches = np.flatnonzero(np.all(voxels == [x, y, z], axis=1))
+        if not len(matches):
+            abort(404)
+    etag = f'{version}-{stem}' + (f'-{page}' if thumbnail_encoder.normalize == 'page' else '')
+
+    response = make_response()
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f'private, max-age={MAX_AGE}, immutable'
+    if request.if_none_match.contains(etag):
+        response.status_code = 304
+        return response
+
+    thumbnails = cached_thumbnails(tomogram, tomo_key, voxels, hw, avg)
+    thumbnail = thumbnails[matches[0]] if thumbnail_encoder.normalize == 'page' else thumbnails[0]
+    response.set_data(thumbnail)
+    response.mimetype = MIME_TYPES[ext]
+    return response
+
+
+def register_thumbnail_route(app):
+    # under the dash pathname prefix, so urls built with get_relative_path resolve
+    app.server.add_url_rule(f'{app.config.routes_pathname_prefix}thumbnails/<run>/<name>',
+                            'thumbnail', serve_thumbnail)